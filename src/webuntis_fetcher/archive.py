@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from webuntis_fetcher.files import replace_file
+
+# None if no archive_dir is configured
+directory = None
+
+
+def configure(config):
+    global directory
+    directory = config.get("OUTPUT", "archive_dir", fallback=None)
+
+
+def object_path(digest: str) -> str:
+    return os.path.join(directory, "objects", digest[:2], f"{digest}.json.gz")
+
+
+def section_path(section: str) -> str:
+    return os.path.join(directory, "sections", re.sub(r"[^\w.-]", "_", section))
+
+
+def write_atomically(filename: str, content: bytes):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    replace_file(filename, content)
+
+
+def store(content: bytes):
+    """
+    Keeps a raw response compressed under the hash of its content (so identical responses are only
+    stored once) and returns the hash, or None if no archive is configured.
+    """
+    if directory is None:
+        return None
+    digest = hashlib.sha256(content).hexdigest()
+    filename = object_path(digest)
+    if not os.path.isfile(filename):
+        try:
+            write_atomically(filename, gzip.compress(content))
+        except OSError as e:
+            logging.log(logging.WARNING, f"could not archive response in {directory}: {e}")
+            return None
+    return digest
+
+
+def load(digest: str) -> dict:
+    with gzip.open(object_path(digest)) as file:
+        return json.load(file)
+
+
+def record(section: str, data: dict):
+    """
+    Writes one entry per fetched week of the section which refers to the archived responses -
+    a week fetched again replaces its entry, the responses themselves stay in the archive.
+    """
+    archived = data.get("archived")
+    if directory is None or archived is None:
+        return
+    for week_start_date, weekly_data in sorted(archived["weeks"].items()):
+        if weekly_data is None:
+            continue
+        filename = os.path.join(section_path(section), f"{week_start_date}.json")
+        try:
+            pageconfig = archived["pageconfig"]
+            if pageconfig is None and os.path.isfile(filename):
+                # the person id came from the metadata cache, so the pageconfig of the last entry still applies
+                with open(filename) as file:
+                    pageconfig = json.load(file).get("pageconfig")
+            entry = {"fetched": time.time(), "person_id": data["person_id"], "weekly_data": weekly_data,
+                     "pageconfig": pageconfig, "timegrid": archived["timegrid"]}
+            write_atomically(filename, json.dumps(entry, sort_keys=True).encode("utf-8"))
+        except (OSError, ValueError) as e:
+            logging.log(logging.WARNING, f"{section}: could not archive week {week_start_date} in {directory}: {e}")
+
+
+def weeks_of(section: str) -> dict:
+    """
+    Returns the archived entries of the section: ISO date of the week's Monday -> entry.
+    """
+    path = section_path(section)
+    if directory is None or not os.path.isdir(path):
+        return dict()
+    entries = dict()
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith(".json"):
+            with open(os.path.join(path, filename)) as file:
+                entries[filename[:-len(".json")]] = json.load(file)
+    return entries
@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+def replace_file(filename: str, content, private: bool = False):
+    """
+    Writes the content (str or bytes) to a temporary file next to the target and then replaces the target
+    with it, so readers (e.g. a web server or another run) never see a partially written file. The file
+    keeps its permissions - a new one gets the default permissions or, if private is set, is only
+    readable by the owner.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    # a unique name, because other runs (e.g. timetable and messages started by cron) might write the same file
+    file_descriptor, temp_filename = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(filename)}.",
+                                                      suffix=".tmp")
+    try:
+        if isinstance(content, bytes):
+            with os.fdopen(file_descriptor, "wb") as file:
+                file.write(content)
+        else:
+            with os.fdopen(file_descriptor, "w", newline="") as file:
+                file.write(content)
+        if not private:
+            if os.path.exists(filename):
+                mode = os.stat(filename).st_mode & 0o777
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            # temporary files are only readable by the owner
+            os.chmod(temp_filename, mode)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+
+
+def read_json(filename: str, description: str) -> dict:
+    """
+    Returns the content of the JSON file, or an empty dict if it doesn't exist or can't be read.
+    """
+    if filename is None or not os.path.isfile(filename):
+        return dict()
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.log(logging.WARNING, f"ignoring unreadable {description} {filename}: {e}")
+        return dict()
+
+
+def write_json(filename: str, content: dict, description: str, private: bool = False, **options) -> bool:
+    """
+    Replaces the JSON file - it's only a cache, so errors are logged, not raised. Returns if it was written.
+    """
+    try:
+        replace_file(filename, json.dumps(content, **options), private)
+        return True
+    except OSError as e:
+        logging.log(logging.WARNING, f"could not write {description} {filename}: {e}")
+        return False
+
+
+class JsonCache:
+    """
+    Entries kept in memory and, if a filename is configured, in a JSON file which is read on first use
+    and written by save() if anything changed.
+    """
+
+    def __init__(self, description: str):
+        self.description = description
+        self.filename = None
+        self.entries = dict()
+        self.loaded = False
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def configure(self, filename):
+        with self.lock:
+            if filename != self.filename:
+                self.entries = dict()
+                self.loaded = False
+            self.filename = filename
+
+    def read(self):
+        """
+        Reads the file if not done yet - the lock must be held.
+        """
+        if not self.loaded:
+            self.loaded = True
+            self.entries = read_json(self.filename, self.description)
+
+    def save(self):
+        with self.lock:
+            if self.changed and self.filename is not None:
+                self.changed = not write_json(self.filename, self.entries, self.description)
@@ -0,0 +1,29 @@
+import hashlib
+import json
+
+from webuntis_fetcher.files import read_json, replace_file
+
+
+def fingerprint(section_config, data: dict) -> str:
+    """
+    Hashes everything the output of a section depends on: its config, the weeks and the
+    relevant parts of the fetched data (without volatile fields like import timestamps).
+    """
+    weeks = dict()
+    for week_start_date, week_data in data["weeks"].items():
+        if "data" in week_data and "result" in week_data["data"]:
+            week_data = week_data["data"]["result"].get("data")
+        weeks[week_start_date] = week_data
+    normalized = {"config": {key: value for key, value in section_config.items() if key != "password"},
+                  "person_id": data["person_id"],
+                  "weeks": weeks,
+                  "timegrid": data["timegrid"]}
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def load_fingerprints(filename: str) -> dict:
+    return read_json(filename, "state file")
+
+
+def save_fingerprints(filename: str, fingerprints: dict):
+    replace_file(filename, json.dumps(fingerprints, indent=2, sort_keys=True))
@@ -0,0 +1,62 @@
+class GridCell:
+    """
+    A table cell which starts in its row and covers rowspan rows.
+    """
+    __slots__ = ("period", "rowspan")
+
+    def __init__(self, period: dict):
+        self.period = period
+        self.rowspan = 1
+
+
+# marks a position which is covered by a cell of an earlier row
+SPANNED = "spanned"
+
+
+def copy_values_for(source_dict: dict, target_dict: dict, *keys: str):
+    for key in keys:
+        if key in source_dict:
+            target_dict[key] = source_dict[key]
+
+
+def same_content(one: dict, two: dict):
+    return (one.get("cell_class") == two.get("cell_class")
+            and one.get("teacher") == two.get("teacher")
+            and one.get("group") == two.get("group")
+            and one.get("subject") == two.get("subject")
+            and one.get("room") == two.get("room"))
+
+
+def continues(master: dict, period: dict):
+    """
+    Checks if the period is covered by the cell of the "rowspan master" above it:
+    either it has the same content, or the master lasts longer than the period's start.
+    """
+    return (period and same_content(master, period)
+            or "end_time" in master and "start_time" in period and master["end_time"] > period["start_time"])
+
+
+def layout(periods_by_time: dict, days: list) -> list:
+    """
+    Computes the table layout: returns a list with one (start_time, cells) tuple per row, sorted
+    by start time. cells contains one entry per day which is either None (empty cell), a GridCell
+    or SPANNED. Periods which are covered by a rowspan get the values of their "rowspan master".
+    """
+    start_times = sorted(periods_by_time.keys())
+    rows = [(start_time, [None] * len(days)) for start_time in start_times]
+    for column, date in enumerate(days):
+        master = None
+        for start_time, cells in rows:
+            period = periods_by_time[start_time].get(date)
+            if master is not None and period is not None and continues(master.period, period):
+                master.rowspan += 1
+                copy_values_for(master.period, period,
+                                "teacher", "subject", "room", "group", "cell_class", "infotext")
+                cells[column] = SPANNED
+            elif period:
+                master = GridCell(period)
+                cells[column] = master
+            else:
+                master = None
+    return rows
+
@@ -0,0 +1,116 @@
+import logging
+import smtplib
+import threading
+from email.message import EmailMessage
+
+from webuntis_fetcher.metrics import current_section, phase
+
+# seconds to wait for the mail host, so a stalled connection doesn't block the run forever
+SMTP_TIMEOUT = 60
+
+
+class Mailer:
+    """
+    Sends emails over one SMTP connection to the mail host which is kept open for the whole run.
+    Each email is sent right away (so it doesn't stay in memory with its attachments), if the
+    connection was dropped it is opened again.
+    """
+
+    def __init__(self, host: str, port: int = 0, starttls: bool = False,
+                 username: str = None, password: str = None):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.connection = None
+        self.failed = list()
+        self.lock = threading.RLock()
+
+    def connect(self):
+        # smtplib also accepts "host:port" if no port is given
+        connection = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        try:
+            if self.starttls:
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+        except:
+            connection.close()
+            raise
+        self.connection = connection
+
+    def disconnect(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                self.connection.close()
+            self.connection = None
+
+    def deliver(self, mail: EmailMessage):
+        if self.connection is None:
+            self.connect()
+        try:
+            self.connection.send_message(mail)
+        except smtplib.SMTPServerDisconnected:
+            logging.debug(f"connection to {self.host} was dropped, connecting again")
+            self.connection = None
+            self.connect()
+            self.connection.send_message(mail)
+
+    def send(self, mail: EmailMessage, description: str, on_success=None):
+        """
+        Sends the email - on_success is called after it was delivered. If delivering fails,
+        the error is logged and the description is added to the failed list.
+        """
+        with self.lock:
+            try:
+                with phase("smtp", current_section()):
+                    self.deliver(mail)
+            except (smtplib.SMTPException, OSError) as e:
+                logging.log(logging.ERROR, f"could not send {description} via {self.host}: {e}")
+                self.failed.append(description)
+                if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                    # the connection might be in an undefined state
+                    self.disconnect()
+                return
+        if on_success is not None:
+            on_success()
+
+    def close(self):
+        with self.lock:
+            self.disconnect()
+
+
+mailers = dict()
+registry_lock = threading.Lock()
+
+
+def mailer_for(section_config) -> Mailer:
+    """
+    Returns the mailer for the mail host of the given config section.
+    """
+    key = (section_config["mail_host"], section_config.getint("mail_port", fallback=0),
+           section_config.get("mail_username"))
+    with registry_lock:
+        if key not in mailers:
+            mailers[key] = Mailer(section_config["mail_host"],
+                                  port=section_config.getint("mail_port", fallback=0),
+                                  starttls=section_config.getboolean("mail_starttls", fallback=False),
+                                  username=section_config.get("mail_username"),
+                                  password=section_config.get("mail_password"))
+        return mailers[key]
+
+
+def close_all() -> list:
+    """
+    Closes all connections. Returns the descriptions of all emails which could not be delivered.
+    """
+    failed = list()
+    with registry_lock:
+        for mailer in mailers.values():
+            mailer.close()
+            failed.extend(mailer.failed)
+        mailers.clear()
+    return failed
@@ -0,0 +1,81 @@
+import csv
+import datetime
+import io
+import logging
+import os
+import threading
+
+from webuntis_fetcher.files import replace_file
+
+
+class MessageIdStore:
+    """
+    The IDs of the handled messages, together with the date they were handled. Each new ID
+    is appended to the file at once, so an interrupted run doesn't send the same messages
+    again. Files written by older versions (only the IDs) can be read as well.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.handled = dict()
+        self.lock = threading.Lock()
+        if os.path.isfile(filename):
+            with open(filename, newline='') as message_id_file:
+                for row in csv.reader(message_id_file, delimiter=','):
+                    if not row:
+                        continue
+                    try:
+                        handled_on = datetime.date.fromisoformat(row[1]) if len(row) > 1 else None
+                    except ValueError:
+                        handled_on = None
+                    self.handled[int(row[0])] = handled_on
+
+    def __contains__(self, message_id) -> bool:
+        return message_id in self.handled
+
+    def __len__(self) -> int:
+        return len(self.handled)
+
+    def add(self, message_id: int):
+        with self.lock:
+            if message_id in self.handled:
+                return
+            today = datetime.date.today()
+            line = io.StringIO()
+            csv.writer(line, delimiter=',', quoting=csv.QUOTE_MINIMAL).writerow([message_id, today.isoformat()])
+            # one write call in append mode, so the line is either written completely or not at all
+            with open(self.filename, 'a', newline='') as message_id_file:
+                message_id_file.write(line.getvalue())
+                message_id_file.flush()
+                os.fsync(message_id_file.fileno())
+            self.handled[message_id] = today
+
+    def compact(self, retention_days: int = None, returned_ids=None, prune_unseen: bool = False):
+        """
+        Drops the IDs which were handled more than retention_days ago and - if prune_unseen is set -
+        all IDs which the server didn't return anymore. IDs contained in returned_ids are always kept,
+        otherwise their messages would be sent again. IDs from files of older versions don't have
+        a date, their retention starts now.
+        """
+        with self.lock:
+            today = datetime.date.today()
+            keep = dict()
+            for message_id, handled_on in self.handled.items():
+                if returned_ids is not None and message_id in returned_ids:
+                    pass
+                elif prune_unseen and returned_ids is not None:
+                    continue
+                elif (retention_days is not None and handled_on is not None
+                      and (today - handled_on).days > retention_days):
+                    continue
+                keep[message_id] = handled_on or today
+            if keep == self.handled:
+                return
+            if len(keep) < len(self.handled):
+                logging.debug(f"dropping {len(self.handled) - len(keep)} message IDs from {self.filename}")
+            content = io.StringIO()
+            message_id_writer = csv.writer(content, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+            for message_id, handled_on in keep.items():
+                message_id_writer.writerow([message_id, handled_on.isoformat()])
+            replace_file(self.filename, content.getvalue())
+            self.handled = keep
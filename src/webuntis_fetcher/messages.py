@@ -1,120 +1,251 @@
-import csv
 import logging
 import mimetypes
 import os
-import smtplib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 
 import requests
 
+from webuntis_fetcher.mail import close_all, mailer_for
+from webuntis_fetcher.message_ids import MessageIdStore
+from webuntis_fetcher.metrics import bind, phase
+from webuntis_fetcher.pipeline import Pipeline
+from webuntis_fetcher.session import FetchError, get_login, session_for
 
-def handle_msg(msg, confirm, already_read_messages, config, section, cookies, headers):
-    if not msg["id"] in already_read_messages:
-        print(f'UNREAD{" TO CONFIRM" if confirm else ""}  {msg["id"]} - {msg["subject"]}')
-
-        message_response = requests.get(
-            f'{config[section]["server"]}/WebUntis/api/rest/view/v1/messages/{msg["id"]}',
-            cookies=cookies,
-            headers=headers)
-        msg_details = message_response.json()
-        msg_attachments = dict()
-        if "storageAttachments" in msg_details and msg_details["storageAttachments"]:
-            for att in msg_details["storageAttachments"]:
-                storageurl_response = requests.get(
-                    f'{config[section]["server"]}/WebUntis/api/rest/view/v1/messages/{att["id"]}/attachmentstorageurl',
-                    cookies=cookies,
-                    headers=headers)
-                storage_json = storageurl_response.json()
-                download_url = storage_json["downloadUrl"]
-                amazon_headers = dict()
-                for header_entry in storage_json["additionalHeaders"]:
-                    amazon_headers[header_entry["key"]] = header_entry["value"]
-                download_response = requests.get(download_url,
-                                                 cookies=cookies,
-                                                 headers=amazon_headers)
-                msg_attachments[att["name"]] = download_response.content
-
-        confirm_timestamp = None
-        if confirm:
+
+def spool_attachment(login, att, spool_dir: str, max_size: int):
+    """
+    Downloads an attachment in chunks to a file in the spool directory and returns its path,
+    or None if it is larger than max_size bytes.
+    """
+    storageurl_response = login.get(f'api/rest/view/v1/messages/{att["id"]}/attachmentstorageurl')
+    storage_json = storageurl_response.json()
+    download_url = storage_json["downloadUrl"]
+    amazon_headers = dict()
+    for header_entry in storage_json["additionalHeaders"]:
+        amazon_headers[header_entry["key"]] = header_entry["value"]
+    with session_for(download_url).get(download_url, cookies=login.cookies, headers=amazon_headers,
+                                       stream=True) as download_response:
+        size = int(download_response.headers.get("Content-Length", 0))
+        if size <= max_size:
+            spool_file = tempfile.NamedTemporaryFile(dir=spool_dir, prefix="webuntis-attachment-", delete=False)
+            try:
+                with spool_file:
+                    size = 0
+                    for chunk in download_response.iter_content(chunk_size=64 * 1024):
+                        size += len(chunk)
+                        if size > max_size:
+                            break
+                        spool_file.write(chunk)
+            except BaseException:
+                os.remove(spool_file.name)
+                raise
+            if size <= max_size:
+                return spool_file.name
+            os.remove(spool_file.name)
+    logging.log(logging.WARNING, f'attachment {att["name"]} is larger than {max_size} bytes, skipping it')
+    return None
+
+
+def spool_attachments(login, attachments: list, section_config) -> list:
+    """
+    Downloads the attachments in parallel, see spool_attachment(). If one download fails,
+    the already downloaded files are removed.
+    """
+    spool_dir = section_config.get("attachment_spool_dir", tempfile.gettempdir())
+    max_size = int(section_config.getfloat("attachment_max_size", fallback=25) * 1024 * 1024)
+    workers = section_config.getint("attachment_workers", fallback=4)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(attachments)))) as executor:
+        futures = [executor.submit(bind(spool_attachment), login, att, spool_dir, max_size) for att in attachments]
+    try:
+        return [future.result() for future in futures]
+    except BaseException:
+        for future in futures:
+            if future.exception() is None and future.result() is not None:
+                os.remove(future.result())
+        raise
+
+
+class MessageJob:
+    """
+    An unread message which is sent by email. The steps are run by the pipeline in run(),
+    see there.
+    """
+
+    def __init__(self, msg, confirm, already_read_messages, config, section, login):
+        self.msg = msg
+        self.confirm = confirm
+        self.already_read_messages = already_read_messages
+        self.section_config = config[section]
+        self.section = section
+        self.login = login
+        self.msg_details = None
+        # (name, spool file) - several attachments may have the same name
+        self.msg_attachments = list()
+        self.skipped_attachments = list()
+        self.confirm_timestamp = None
+        self.mail = None
+
+    def fetch_details(self):
+        message_response = self.login.get(f'api/rest/view/v1/messages/{self.msg["id"]}')
+        self.msg_details = message_response.json()
+
+    def fetch_attachments(self):
+        if "storageAttachments" in self.msg_details and self.msg_details["storageAttachments"]:
+            attachments = self.msg_details["storageAttachments"]
+            spooled = spool_attachments(self.login, attachments, self.section_config)
+            for att, spool_file in zip(attachments, spooled):
+                if spool_file is None:
+                    self.skipped_attachments.append(att["name"])
+                else:
+                    self.msg_attachments.append((att["name"], spool_file))
+
+    def confirm_read(self):
+        if self.confirm:
             try:
-                confirm_response = requests.post(
-                    f'{config[section]["server"]}/WebUntis/api/rest/view/v1/messages/{msg["id"]}/read-confirmation',
-                    cookies=cookies,
-                    headers=headers)
+                confirm_response = self.login.post(f'api/rest/view/v1/messages/{self.msg["id"]}/read-confirmation')
                 confirm_details = confirm_response.json()
-                confirm_timestamp = confirm_details["confirmationDate"]
+                self.confirm_timestamp = confirm_details["confirmationDate"]
             except:
-                print(f'COULD NOT CONFIRM  {msg["id"]} - {msg["subject"]}')
+                print(f'COULD NOT CONFIRM  {self.msg["id"]} - {self.msg["subject"]}')
 
+    def compose(self):
+        msg = self.msg
+        msg_details = self.msg_details
         mail = EmailMessage()
         content = msg_details["content"] if "content" in msg_details and msg_details["content"] is not None else ""
-        if confirm_timestamp:
-            content += f"\n\nMessage was confirmed at {confirm_timestamp}"
+        if self.confirm_timestamp:
+            content += f"\n\nMessage was confirmed at {self.confirm_timestamp}"
+        for att in self.skipped_attachments:
+            content += f"\n\nAttachment {att} was not included because it is too large"
         mail.set_content(content)
-        for att in msg_attachments:
-            mimetype = mimetypes.guess_type(url=att)
-            if "/" in mimetype[0]:
-                splitted = mimetype[0].split("/")
-                mime1 = splitted[0]
-                mime2 = splitted[1]
-            else:
-                mime1 = mimetype[0]
-                mime2 = mimetype[1]
-            mail.add_attachment(msg_attachments[att], maintype=mime1, subtype=mime2,
-                                filename=att)
+        try:
+            for att, spool_file in self.msg_attachments:
+                mimetype = mimetypes.guess_type(url=att)
+                if "/" in mimetype[0]:
+                    splitted = mimetype[0].split("/")
+                    mime1 = splitted[0]
+                    mime2 = splitted[1]
+                else:
+                    mime1 = mimetype[0]
+                    mime2 = mimetype[1]
+                with open(spool_file, "rb") as attachment_file:
+                    mail.add_attachment(attachment_file.read(), maintype=mime1, subtype=mime2,
+                                        filename=att)
+        finally:
+            self.remove_spool_files()
         mail['Subject'] = f'[{msg["sender"]["displayName"]}] {msg["subject"]}'
-        mail['From'] = config[section]["mail_from"]
-        mail['To'] = config[section]["mail_to"]
+        mail['From'] = self.section_config["mail_from"]
+        mail['To'] = self.section_config["mail_to"]
+        self.mail = mail
 
-        s = smtplib.SMTP(config[section]["mail_host"])
-        s.send_message(mail)
-        s.quit()
+    def deliver(self):
+        # the message only counts as read when the email was delivered
+        mailer_for(self.section_config).send(self.mail, f'message {self.msg["id"]} - {self.msg["subject"]}',
+                                             on_success=lambda: self.already_read_messages.add(self.msg["id"]))
+        # the email contains the attachments, so it isn't kept until the end of the run
+        self.mail = None
 
-        already_read_messages.append(msg["id"])
+    def remove_spool_files(self):
+        for name, spool_file in self.msg_attachments:
+            if os.path.isfile(spool_file):
+                os.remove(spool_file)
 
+    def failed(self, error: Exception):
+        self.remove_spool_files()
+        if isinstance(error, FetchError):
+            logging.log(logging.ERROR, f'{self.section}: {error}')
+        else:
+            logging.log(logging.ERROR, f'{self.section}: could not handle message {self.msg["id"]} - {error}')
 
-def run(config):
-    for section in config:
-        if section not in ('DEFAULT', 'OUTPUT'):
-            if "message_id_file" not in config[section]:
-                logging.log(logging.ERROR, f"message_id_file not configured for {section}")
-                exit(2)
-            already_read_messages = list()
-            if os.path.isfile(config[section]["message_id_file"]):
-                with open(config[section]["message_id_file"], newline='') as message_id_file:
-                    message_id_reader = csv.reader(message_id_file, delimiter=',')
-                    for row in message_id_reader:
-                        already_read_messages.append(int(row[0]))
 
-            try:
-                response_initial = requests.get(
-                    f'{config[section]["server"]}/WebUntis/?school={config[section]["school"]}')
-                cookies = response_initial.cookies
-                requests.post(f'{config[section]["server"]}/WebUntis/j_spring_security_check', cookies=cookies,
-                              params={"school": config[section]["school"],
-                                      "j_username": config[section]["username"],
-                                      "j_password": config[section]["password"],
-                                      "token": ""})
-                token_new_response = requests.get(
-                    f'{config[section]["server"]}/WebUntis/api/token/new',
-                    cookies=cookies)
-                headers = {"Authorization": f"Bearer {token_new_response.text}"}
-                messages_response = requests.get(f'{config[section]["server"]}/WebUntis/api/rest/view/v1/messages',
-                                                 cookies=cookies,
-                                                 headers=headers)
-                messages = messages_response.json()
-
-                if "readConfirmationMessages" in messages:
-                    for msg in messages["readConfirmationMessages"]:
-                        handle_msg(msg, True, already_read_messages, config, section, cookies, headers)
-                if "incomingMessages" in messages:
-                    for msg in messages["incomingMessages"]:
-                        handle_msg(msg, False, already_read_messages, config, section, cookies, headers)
-
-                with open(config[section]["message_id_file"], 'w', newline='') as message_id_file:
-                    message_id_writer = csv.writer(message_id_file, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-                    for already_read_message_id in already_read_messages:
-                        message_id_writer.writerow([already_read_message_id])
-
-            except requests.RequestException as re:
-                pass
+def measured(name: str, step):
+    """
+    Returns the step of MessageJob so that its duration is recorded as phase of the job's section.
+    """
+    def measured_step(job: MessageJob):
+        with phase(name, job.section):
+            return step(job)
+    return measured_step
+
+
+def fetch_section(section: str, config, stores: dict, in_progress: set, pipeline: Pipeline, lock: threading.Lock):
+    """
+    Fetches the list of messages and puts the unread ones into the pipeline. Returns the IDs of
+    all listed messages, or None if the list could not be fetched.
+    """
+    already_read_messages = stores[config[section]["message_id_file"]]
+    try:
+        with phase("list", section):
+            login = get_login(config[section])
+            messages_response = login.get('api/rest/view/v1/messages')
+            messages = messages_response.json()
+    except FetchError as fe:
+        logging.log(logging.ERROR, f"{section}: {fe}")
+        return None
+    except requests.RequestException as e:
+        # connection problems only affect this section
+        logging.log(logging.WARNING, f"{section}: {e}")
+        return None
+
+    for key, confirm in (("readConfirmationMessages", True), ("incomingMessages", False)):
+        for msg in messages.get(key, ()):
+            with lock:
+                # a message may be listed twice or the same message ID file may be used by multiple sections
+                seen_key = (already_read_messages.filename, msg["id"])
+                if msg["id"] in already_read_messages or seen_key in in_progress:
+                    continue
+                in_progress.add(seen_key)
+            print(f'UNREAD{" TO CONFIRM" if confirm else ""}  {msg["id"]} - {msg["subject"]}')
+            pipeline.submit(MessageJob(msg, confirm, already_read_messages, config, section, login))
+    return {msg["id"] for key in ("readConfirmationMessages", "incomingMessages") for msg in messages.get(key, ())}
+
+
+def run(config) -> bool:
+    """
+    Sends the unread messages of all sections by email. Returns False if anything went wrong.
+    """
+    sections = [section for section in config if section not in ('DEFAULT', 'OUTPUT')]
+    stores = dict()
+    for section in sections:
+        if "message_id_file" not in config[section]:
+            logging.log(logging.ERROR, f"message_id_file not configured for {section}")
+            exit(2)
+        if config[section]["message_id_file"] not in stores:
+            stores[config[section]["message_id_file"]] = MessageIdStore(config[section]["message_id_file"])
+
+    # every message goes through these steps, each one with its own limit of parallel executions
+    workers = config.getint("OUTPUT", "workers", fallback=4)
+    pipeline = Pipeline([(measured("details", MessageJob.fetch_details), workers),
+                         (measured("attachments", MessageJob.fetch_attachments), workers),
+                         (measured("confirm", MessageJob.confirm_read), workers),
+                         (measured("compose", MessageJob.compose), 1),
+                         (measured("deliver", MessageJob.deliver), workers)],
+                        MessageJob.failed)
+    in_progress = set()
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        returned_ids = list(executor.map(lambda section: fetch_section(section, config, stores, in_progress,
+                                                                       pipeline, lock),
+                                         sections))
+    pipeline.join()
+    # deliver the queued emails so the sent messages are stored as read
+    failed_deliveries = close_all()
+
+    # sections can share a message ID file, so only the IDs returned for all of them are kept
+    returned_ids_by_file = dict()
+    for section, section_returned_ids in zip(sections, returned_ids):
+        filename = config[section]["message_id_file"]
+        if section_returned_ids is None or returned_ids_by_file.get(filename, set()) is None:
+            returned_ids_by_file[filename] = None
+        else:
+            returned_ids_by_file[filename] = returned_ids_by_file.get(filename, set()) | section_returned_ids
+    for section in sections:
+        filename = config[section]["message_id_file"]
+        retention_days = config[section].getint("message_id_retention_days", fallback=None)
+        prune_unseen = config[section].getboolean("message_id_prune", fallback=False)
+        if returned_ids_by_file[filename] is not None and (retention_days is not None or prune_unseen):
+            stores[filename].compact(retention_days, returned_ids_by_file[filename], prune_unseen)
+    return pipeline.errors == 0 and not failed_deliveries and None not in returned_ids
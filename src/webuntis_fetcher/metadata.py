@@ -0,0 +1,60 @@
+import time
+
+from webuntis_fetcher.files import JsonCache
+
+DEFAULT_CACHE_HOURS = 24
+
+
+def key_of(section_config) -> str:
+    """
+    Identifies the metadata of a section: the same person can look different with another login or mode.
+    """
+    return "|".join([section_config["server"], section_config["school"], section_config["username"],
+                     section_config["firstname"], section_config["lastname"],
+                     "student" if "class" in section_config else "teacher"])
+
+
+class MetadataCache(JsonCache):
+    """
+    Keeps values which rarely change (the person id and the timegrid of each section) in memory and,
+    if a filename is configured, in a file so a steady-state run only has to fetch the weekly data.
+    """
+
+    def __init__(self):
+        super().__init__("metadata cache")
+        self.ttl_seconds = DEFAULT_CACHE_HOURS * 3600
+
+    def configure(self, filename, ttl_seconds: float):
+        super().configure(filename)
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key: str, name: str):
+        """
+        Returns the cached value if it's younger than the TTL, else None.
+        """
+        with self.lock:
+            self.read()
+            entry = self.entries.get(key, dict()).get(name)
+        if entry is None or time.time() - entry["stored"] >= self.ttl_seconds:
+            return None
+        return entry["value"]
+
+    def put(self, key: str, name: str, value):
+        with self.lock:
+            self.read()
+            self.entries.setdefault(key, dict())[name] = {"stored": time.time(), "value": value}
+            self.changed = True
+
+    def forget(self, key: str):
+        with self.lock:
+            self.read()
+            if self.entries.pop(key, None) is not None:
+                self.changed = True
+
+
+cache = MetadataCache()
+
+
+def configure(config):
+    cache.configure(config.get("OUTPUT", "metadata_cache_file", fallback=None),
+                    3600 * config.getfloat("OUTPUT", "metadata_cache_hours", fallback=DEFAULT_CACHE_HOURS))
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from webuntis_fetcher.files import replace_file
+
+# used for everything which doesn't belong to a section
+NO_SECTION = "-"
+
+lock = threading.Lock()
+local = threading.local()
+mode = None
+started = None
+phases = dict()
+requests_by_section = dict()
+hosts = dict()
+
+
+def start(run_mode: str):
+    """
+    Forgets the numbers of the previous run and starts measuring a new one.
+    """
+    global mode, started
+    with lock:
+        mode = run_mode
+        started = time.time()
+        phases.clear()
+        requests_by_section.clear()
+        hosts.clear()
+
+
+def current_section() -> str:
+    return getattr(local, "section", None) or NO_SECTION
+
+
+@contextmanager
+def section_context(section: str):
+    previous = getattr(local, "section", None)
+    local.section = section
+    try:
+        yield
+    finally:
+        local.section = previous
+
+
+def bind(function):
+    """
+    Returns a function which runs with the current section - for functions which are executed
+    in other threads, e.g. by a thread pool.
+    """
+    section = current_section()
+
+    def bound(*args, **kwargs):
+        with section_context(section):
+            return function(*args, **kwargs)
+    return bound
+
+
+@contextmanager
+def phase(name: str, section: str = None):
+    """
+    Measures the wall time of the enclosed block as phase of the given (or else the current) section.
+    """
+    section = section or current_section()
+    begin = time.perf_counter()
+    failed = False
+    try:
+        with section_context(section):
+            yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        duration = time.perf_counter() - begin
+        with lock:
+            entry = phases.setdefault((section, name), {"count": 0, "seconds": 0.0, "errors": 0})
+            entry["count"] += 1
+            entry["seconds"] += duration
+            if failed:
+                entry["errors"] += 1
+
+
+def record_response(response, *args, **kwargs):
+    """
+    Response hook for the sessions: counts the request, its status code and the response size.
+    Streamed responses are counted with their Content-Length so they are not read here.
+    """
+    if kwargs.get("stream"):
+        size = int(response.headers.get("Content-Length", 0))
+    else:
+        size = len(response.content)
+    with lock:
+        entry = requests_by_section.setdefault(current_section(), {"count": 0, "bytes": 0, "status": dict()})
+        entry["count"] += 1
+        entry["bytes"] += size
+        status = str(response.status_code)
+        entry["status"][status] = entry["status"].get(status, 0) + 1
+
+
+def record_host(host: str, per_minute: float, burst: int, waited_seconds: float, throttled: bool):
+    """
+    Counts a request against the budget of its host (see ratelimit).
+    """
+    with lock:
+        entry = hosts.setdefault(host, {"requests": 0, "throttled": 0, "wait_seconds": 0.0})
+        entry["requests"] += 1
+        entry["wait_seconds"] += waited_seconds
+        if throttled:
+            entry["throttled"] += 1
+        entry["per_minute"] = per_minute
+        entry["burst"] = burst
+
+
+def summary() -> dict:
+    with lock:
+        sections = dict()
+        for (section, name), entry in phases.items():
+            sections.setdefault(section, {"phases": dict(), "requests": {"count": 0, "bytes": 0, "status": dict()}})
+            sections[section]["phases"][name] = {"count": entry["count"], "seconds": round(entry["seconds"], 3),
+                                                 "errors": entry["errors"]}
+        for section, entry in requests_by_section.items():
+            sections.setdefault(section, {"phases": dict(), "requests": None})
+            sections[section]["requests"] = {"count": entry["count"], "bytes": entry["bytes"],
+                                             "status": dict(entry["status"])}
+        duration = time.time() - started if started is not None else None
+        host_usage = dict()
+        for host, entry in hosts.items():
+            # the share of the requests the rate limit would have allowed during the run
+            budget = entry["burst"] + entry["per_minute"] * duration / 60 if duration is not None else 0
+            host_usage[host] = {"requests": entry["requests"], "throttled": entry["throttled"],
+                                "wait_seconds": round(entry["wait_seconds"], 3),
+                                "requests_per_minute": entry["per_minute"],
+                                "budget_used": round(entry["requests"] / budget, 3)
+                                if entry["per_minute"] > 0 and budget else None}
+        return {"mode": mode,
+                "started": started,
+                "duration_seconds": round(duration, 3) if duration is not None else None,
+                "sections": sections,
+                "hosts": host_usage}
+
+
+def label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(result: dict) -> str:
+    run_labels = f'mode="{label(result["mode"])}"'
+    lines = ["# TYPE webuntis_fetcher_run_duration_seconds gauge",
+             f'webuntis_fetcher_run_duration_seconds{{{run_labels}}} {result["duration_seconds"]}',
+             "# TYPE webuntis_fetcher_last_run_timestamp_seconds gauge",
+             f'webuntis_fetcher_last_run_timestamp_seconds{{{run_labels}}} {result["started"]}']
+    metric_lines = {"webuntis_fetcher_phase_seconds": list(),
+                    "webuntis_fetcher_phase_count": list(),
+                    "webuntis_fetcher_phase_errors": list(),
+                    "webuntis_fetcher_requests": list(),
+                    "webuntis_fetcher_response_bytes": list()}
+    for section, entry in sorted(result["sections"].items()):
+        section_labels = f'{run_labels},section="{label(section)}"'
+        for name, values in sorted(entry["phases"].items()):
+            phase_labels = f'{section_labels},phase="{label(name)}"'
+            metric_lines["webuntis_fetcher_phase_seconds"].append(f'{{{phase_labels}}} {values["seconds"]}')
+            metric_lines["webuntis_fetcher_phase_count"].append(f'{{{phase_labels}}} {values["count"]}')
+            metric_lines["webuntis_fetcher_phase_errors"].append(f'{{{phase_labels}}} {values["errors"]}')
+        if entry["requests"] is not None:
+            for status, count in sorted(entry["requests"]["status"].items()):
+                metric_lines["webuntis_fetcher_requests"].append(f'{{{section_labels},status="{status}"}} {count}')
+            metric_lines["webuntis_fetcher_response_bytes"].append(f'{{{section_labels}}} {entry["requests"]["bytes"]}')
+    for name in ("requests", "throttled", "wait_seconds", "budget_used"):
+        metric_lines[f"webuntis_fetcher_host_{name}"] = [
+            f'{{{run_labels},host="{label(host)}"}} {entry[name]}'
+            for host, entry in sorted(result.get("hosts", dict()).items()) if entry[name] is not None]
+    for name, values in metric_lines.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{value}" for value in values)
+    return "\n".join(lines) + "\n"
+
+
+def report(config):
+    """
+    Logs the numbers of the run as JSON (at level INFO if metrics_log is set in OUTPUT, else DEBUG) and
+    writes them to prometheus_textfile_dir (if set in OUTPUT) for the textfile collector of the node exporter.
+    """
+    result = summary()
+    level = logging.INFO if config.getboolean("OUTPUT", "metrics_log", fallback=False) else logging.DEBUG
+    logging.log(level, json.dumps({"metrics": result}, sort_keys=True))
+    if config.has_option("OUTPUT", "prometheus_textfile_dir"):
+        filename = os.path.join(config["OUTPUT"]["prometheus_textfile_dir"], f"webuntis_fetcher_{result['mode']}.prom")
+        # the collector must never see a half-written file
+        replace_file(filename, prometheus_text(result))
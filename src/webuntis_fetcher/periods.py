@@ -0,0 +1,93 @@
+import datetime
+
+# element types in the weekly data of WebUntis
+GROUP = 1
+TEACHER = 2
+SUBJECT = 3
+ROOM = 4
+STUDENT = 5
+
+# the texts of a period, in the order they are appended to the info text
+TEXT_ATTRIBUTES = ("lessonText", "periodText", "periodInfo", "substText", "staffText")
+
+
+def parse_time(value) -> datetime.time:
+    """
+    WebUntis sends times as numbers like 745 or 1330.
+    """
+    value = str(value)
+    if value == '0':
+        return datetime.time(hour=0, minute=0)
+    return datetime.time(hour=int(value[:-2]), minute=int(value[-2:]))
+
+
+def parse_date(value) -> datetime.date:
+    """
+    WebUntis sends dates as numbers like 20241007.
+    """
+    value = str(value)
+    return datetime.date(year=int(value[:4]), month=int(value[4:6]), day=int(value[6:]))
+
+
+class ElementIndex:
+    """
+    Names of the elements (groups, teachers, subjects, rooms, students) of the weekly data,
+    indexed by type and id.
+    """
+
+    def __init__(self, elements: list):
+        self.names = dict()
+        for element in elements:
+            # teachers are displayed with their short name, everything else with the display name:
+            if element["type"] == TEACHER:
+                name = element.get("name")
+            elif element["type"] in (GROUP, SUBJECT, ROOM, STUDENT):
+                name = element.get("displayname")
+            else:
+                continue
+            self.names.setdefault((element["type"], element["id"]), name)
+
+    def name(self, element_type: int, element_id: int):
+        return self.names.get((element_type, element_id))
+
+
+class Period:
+    """
+    One period of the weekly data with all element names already resolved. The name lists
+    are ordered by element id, names which could not be resolved are left out.
+    """
+    __slots__ = ("date", "start_time", "end_time", "cell_state",
+                 "groups", "teachers", "original_teachers", "subjects", "original_subjects",
+                 "rooms", "original_rooms", "texts")
+
+    def __init__(self, data: dict, index: ElementIndex):
+        self.date = parse_date(data["date"])
+        self.start_time = parse_time(data["startTime"])
+        self.end_time = parse_time(data["endTime"])
+        self.cell_state = data["cellState"]
+        elements = data["elements"]
+        self.groups = resolve(index, elements, GROUP, "id")
+        self.teachers = resolve(index, elements, TEACHER, "id")
+        self.original_teachers = resolve(index, elements, TEACHER, "orgId")
+        self.subjects = resolve(index, elements, SUBJECT, "id")
+        self.original_subjects = resolve(index, elements, SUBJECT, "orgId")
+        self.rooms = resolve(index, elements, ROOM, "id")
+        self.original_rooms = resolve(index, elements, ROOM, "orgId")
+        self.texts = tuple(data[attribute] for attribute in TEXT_ATTRIBUTES
+                           if attribute in data and data[attribute])
+
+
+def resolve(index: ElementIndex, elements: list, element_type: int, attribute: str) -> list:
+    element_ids = sorted(element[attribute] for element in elements
+                         if element["type"] == element_type and element.get(attribute) is not None)
+    names = [index.name(element_type, element_id) for element_id in element_ids]
+    return [name for name in names if name is not None]
+
+
+def parse_periods(week_data: dict, person_id) -> list:
+    """
+    Returns the periods of the given person from the weekly data response.
+    """
+    data = week_data["data"]["result"]["data"]
+    index = ElementIndex(data["elements"])
+    return [Period(period, index) for period in data["elementPeriods"][str(person_id)]]
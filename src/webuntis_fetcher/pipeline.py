@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Pipeline:
+    """
+    Runs each submitted item through the stages one after the other. Every stage has its own
+    thread pool, so different items can be in different stages at the same time and the
+    throughput is limited by the slowest stage.
+
+    The stages are given as (function, workers) tuples, each function is called with the item.
+    If a stage returns False, the item is done. If it raises an exception, on_error is called
+    with the item and the exception.
+    """
+
+    def __init__(self, stages: list, on_error):
+        self.stages = [function for function, workers in stages]
+        self.executors = [ThreadPoolExecutor(max_workers=max(1, workers)) for function, workers in stages]
+        self.on_error = on_error
+        self.running = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+
+    def submit(self, item):
+        with self.condition:
+            self.running += 1
+        self.run_stage(0, item)
+
+    def run_stage(self, index: int, item):
+        future = self.executors[index].submit(self.stages[index], item)
+        future.add_done_callback(lambda done: self.stage_done(index, item, done))
+
+    def stage_done(self, index: int, item, future):
+        error = future.exception()
+        if error is None and future.result() is not False and index + 1 < len(self.stages):
+            self.run_stage(index + 1, item)
+            return
+        try:
+            if error is not None:
+                with self.condition:
+                    self.errors += 1
+                self.on_error(item, error)
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    def join(self):
+        """
+        Waits until all submitted items went through the pipeline and stops the thread pools.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.running == 0)
+        for executor in self.executors:
+            executor.shutdown()
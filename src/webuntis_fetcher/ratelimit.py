@@ -0,0 +1,127 @@
+import email.utils
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_REQUESTS_PER_MINUTE = 600
+DEFAULT_BURST = 20
+DEFAULT_CONCURRENT_REQUESTS = 8
+# how often a request answered with 429 is repeated and how long a Retry-After may be at most (seconds)
+THROTTLE_RETRIES = 3
+MAX_RETRY_AFTER = 120
+
+requests_per_minute = DEFAULT_REQUESTS_PER_MINUTE
+burst = DEFAULT_BURST
+concurrent_requests = DEFAULT_CONCURRENT_REQUESTS
+
+limiters = dict()
+registry_lock = threading.Lock()
+
+
+class DeadlineReached(Exception):
+    """
+    Raised when a request could only be started after the given deadline.
+    """
+
+
+class HostLimiter:
+    """
+    A token bucket (requests_per_minute, up to burst requests at once after a quiet period) and a
+    cap on the requests in flight for one host. All sections and modes using the host share it.
+    """
+
+    def __init__(self, host: str, per_minute: float, burst_size: int, max_concurrent: int):
+        self.host = host
+        self.per_minute = per_minute
+        self.burst = max(1, burst_size)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(1, max_concurrent))
+
+    def take(self, until: float = None) -> float:
+        """
+        Waits for a token and returns the seconds waited. If until (a time.monotonic() value)
+        is given and the token isn't available before, DeadlineReached is raised at once.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.per_minute > 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.per_minute / 60)
+                self.updated = now
+                if self.paused_until > now:
+                    delay = self.paused_until - now
+                elif self.per_minute <= 0 or self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    delay = (1 - self.tokens) * 60 / self.per_minute
+                if until is not None and now + delay > until:
+                    raise DeadlineReached(f"no request to {self.host} can be started before the deadline")
+            time.sleep(delay)
+            waited += delay
+
+    @contextmanager
+    def slot(self, until: float = None):
+        """
+        Holds one of the concurrent requests while the block runs, yields the seconds waited.
+        Raises DeadlineReached if the request can't be started before until (see take()).
+        """
+        begin = time.monotonic()
+        if not self.slots.acquire(timeout=None if until is None else max(0.0, until - begin)):
+            raise DeadlineReached(f"no request to {self.host} can be started before the deadline")
+        try:
+            self.take(until)
+            yield time.monotonic() - begin
+        finally:
+            self.slots.release()
+
+    def pause(self, seconds: float):
+        """
+        Called when the host answered with 429: no request is started before the given time has passed.
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+def retry_after(value, attempt: int) -> float:
+    """
+    Returns the seconds to wait from a Retry-After header (seconds or HTTP date),
+    or an exponential backoff if there is none.
+    """
+    seconds = None
+    if value:
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                seconds = None
+    if seconds is None:
+        seconds = 2 ** attempt
+    return min(max(0.0, seconds), MAX_RETRY_AFTER)
+
+
+def configure(config):
+    """
+    Sets the limits used for every host (requests_per_minute, request_burst, concurrent_requests)
+    and drops the limiters of a previous configuration.
+    """
+    global requests_per_minute, burst, concurrent_requests
+    requests_per_minute = config.getfloat("OUTPUT", "requests_per_minute", fallback=DEFAULT_REQUESTS_PER_MINUTE)
+    burst = config.getint("OUTPUT", "request_burst", fallback=DEFAULT_BURST)
+    concurrent_requests = config.getint("OUTPUT", "concurrent_requests", fallback=DEFAULT_CONCURRENT_REQUESTS)
+    with registry_lock:
+        limiters.clear()
+
+
+def limiter_for(host: str) -> HostLimiter:
+    with registry_lock:
+        if host not in limiters:
+            limiters[host] = HostLimiter(host, requests_per_minute, burst, concurrent_requests)
+        return limiters[host]
@@ -0,0 +1,143 @@
+import datetime
+
+from webuntis_fetcher.layout import SPANNED
+
+# the templates are prepared once, rendering only fills in the values
+PAGE_START = '''<html>
+                           <head>
+                           <title>Stundenplan</title>
+                           <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+                           <style>
+                           .width1 { width: 120px }
+                           .width2 { width: 150px }
+                           .height2 { height: 47px }
+                           .text_top { vertical-align: top }
+                           .centered { text-align: center; vertical-align: middle }
+                           .smallbleak { color: #999999; font-size: small }
+                           .bleak { color: #999999 }
+                           .smallbold { font-size: small; font-weight: bold }
+                           .no { text-decoration: line-through }
+                           .spaceleft { padding-left: 0.5em }
+                           .spaceright { padding-right: 0.5em }
+                           .normal { background-color: rgba(245, 160, 35, 0.7) }
+                           .exam { background-color: rgba(255, 235, 0, 0.7) }
+                           .change { background-color: rgba(200, 160, 210) }
+                           .cancel { background-color: rgba(195, 195, 195) }
+                           .warn { background-color: rgba(255, 50, 50) }
+                           </style>
+                           </head>
+                           <body>'''
+PAGE_END = '''</body>
+                                </html>
+'''
+TIMESTAMP = '<span class="smallbold">Stand: {}</span><br/>'.format
+HEADING = '<h2>{}{}</h2>\n'.format
+TABLE_START = '''<table>
+                       <tr>
+                       <td class="width1"></td>
+'''
+# strftime format, the day header is rendered once per date
+DAY = '<td class="width2 centered"><b>%a</b> <span class=smallbleak>%d.%m.</span></td>\n'
+ROW_START = '''</tr>
+<tr>
+                           <td class="height2 text_top">%H:%M Uhr</td>
+'''
+EMPTY_CELL = "<td></td>\n"
+TABLE_END = "</tr>\n</table>\n"
+STALE = '<span class="warn">Keine aktuellen Daten - Stand: {}</span><br/>\n'.format
+STATISTICS = ('<span class="bleak">seit {}: Entfall = {} % / Fach&auml;nderung = {} % /'
+              ' personelle &Auml;nderung = {} %</span>\n').format
+
+NOTHING = dict()
+
+
+def timestamp_line() -> str:
+    return TIMESTAMP(datetime.datetime.now().strftime("%H:%M Uhr, %d.%m.%Y"))
+
+
+def heading(section_config) -> str:
+    return HEADING(section_config["firstname"], f' ({section_config["class"]})' if "class" in section_config else '')
+
+
+def stale(html: str, stored: float) -> str:
+    """
+    Marks the last successful rendering of a section (shown when it couldn't be fetched) with its time.
+    """
+    marker = STALE(datetime.datetime.fromtimestamp(stored).strftime("%H:%M Uhr, %d.%m.%Y"))
+    if "</h2>\n" in html:
+        return html.replace("</h2>\n", "</h2>\n" + marker, 1)
+    return marker + html
+
+
+def statistics_line(statistics) -> str:
+    return STATISTICS(statistics.earliest_date().strftime("%d.%m.%Y"),
+                      round(100 * statistics.percentage_cancelled(), 1),
+                      round(100 * statistics.percentage_changed_subject(), 1),
+                      round(100 * statistics.percentage_changed_teacher(), 1))
+
+
+def changed(values: dict) -> str:
+    """
+    Returns the "no" (planned) value if it differs from the "yes" (actual) value.
+    """
+    if "no" in values and ("yes" not in values or values["no"] != values["yes"]):
+        return values["no"]
+    return ""
+
+
+def cell(period: dict, rowspan: int, student_mode: bool) -> str:
+    if student_mode:
+        group = ""
+        teachers = period.get("teacher")
+        if teachers is not None:
+            teacher_yes = teachers.get("yes", "")
+            teacher_no = changed(teachers)
+            teacher = (f'<span class="spaceleft">{teacher_yes}</span>'
+                       f'<span class="no{" spaceleft" if teacher_yes and teacher_no else ""}">{teacher_no}</span>')
+        else:
+            teacher = ""
+    else:
+        groups = period.get("group", NOTHING)
+        group_yes = groups.get("yes", "")
+        group_no = groups.get("no", "")
+        group = (f'<span class="spaceright">{group_yes}</span>'
+                 f'<span class="no{" spaceleft" if group_yes and group_no else ""}">{group_no}</span>')
+        teacher = ""
+    subjects = period.get("subject", NOTHING)
+    subject_yes = subjects.get("yes", "")
+    subject_no = subjects.get("no", "")
+    rooms = period.get("room", NOTHING)
+    room_yes = rooms.get("yes", "")
+    room_no = changed(rooms)
+    infotext = period.get("infotext")
+    rowspan_attribute = f' rowspan="{rowspan}"' if rowspan > 1 else ""
+    return (f'<td class="centered {period["cell_class"]}"{rowspan_attribute}>{group}'
+            f'{subject_yes}<span class="no{" spaceleft" if subject_yes and subject_no else ""}">{subject_no}</span>'
+            f'{teacher}<br/>'
+            f'<small>@ {room_yes}'
+            f'<span class="no{" spaceleft" if room_yes and room_no else ""}">{room_no}</span></small>'
+            f'{"<br/>" + infotext.strip() if infotext else ""}</td>\n')
+
+
+def table(section_config, days: list, rows: list) -> str:
+    """
+    Renders the table of one week, rows are the result of layout.layout().
+    """
+    student_mode = "class" in section_config
+    parts = [TABLE_START]
+    for date in days:
+        parts.append(date.strftime(DAY))
+    for start_time, cells in rows:
+        parts.append(start_time.strftime(ROW_START))
+        for grid_cell in cells:
+            if grid_cell is None:
+                parts.append(EMPTY_CELL)
+            elif grid_cell is not SPANNED:
+                parts.append(cell(grid_cell.period, grid_cell.rowspan, student_mode))
+    parts.append(TABLE_END)
+    return "".join(parts)
+
+
+def page(sections: list) -> str:
+    return "".join([PAGE_START, timestamp_line(), "\n"] + sections + [PAGE_END])
+
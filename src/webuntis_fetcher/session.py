@@ -0,0 +1,387 @@
+import base64
+import http.cookiejar
+import json
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from webuntis_fetcher import ratelimit
+from webuntis_fetcher.files import read_json, write_json
+from webuntis_fetcher.metrics import phase, record_host, record_response
+
+
+class FetchError(Exception):
+    """
+    Raised when WebUntis answers with an unexpected status code. The exit code is used
+    for the whole run after all other sections were handled.
+    """
+
+    def __init__(self, exit_code: int, message: str):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+class NoCookiesPolicy(http.cookiejar.DefaultCookiePolicy):
+    """
+    The sessions are shared between different logins on the same host, so they must not
+    collect cookies themselves - each login keeps its own cookie jar.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class AuthCache:
+    """
+    Keeps the cookies and bearer token of each login in a file (readable only by the owner)
+    so the next run can skip the login requests as long as the token is valid.
+    """
+
+    def __init__(self, filename: str, ttl_seconds: int):
+        self.filename = filename
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+
+    def read_all(self) -> dict:
+        return read_json(self.filename, "auth cache")
+
+    def write_all(self, entries: dict):
+        write_json(self.filename, entries, "auth cache", private=True)
+
+    def load(self, key: str):
+        """
+        Returns the cached entry (with "cookies", "token" and "expires") if it is still valid, else None.
+        """
+        with self.lock:
+            entry = self.read_all().get(key)
+        if entry is None or entry["expires"] <= time.time():
+            return None
+        return entry
+
+    def store(self, key: str, cookies: requests.cookies.RequestsCookieJar, token: str):
+        expires = time.time() + self.ttl_seconds
+        token_expiry = token_expires(token)
+        if token_expiry is not None:
+            # leave a minute for the requests using the token:
+            expires = min(expires, token_expiry - 60)
+        entry = {"cookies": [{"name": cookie.name, "value": cookie.value, "domain": cookie.domain,
+                              "path": cookie.path, "secure": cookie.secure, "expires": cookie.expires}
+                             for cookie in cookies],
+                 "token": token,
+                 "expires": expires}
+        with self.lock:
+            entries = self.read_all()
+            entries[key] = entry
+            self.write_all(entries)
+
+    def forget(self, key: str):
+        with self.lock:
+            entries = self.read_all()
+            if key in entries:
+                del entries[key]
+                self.write_all(entries)
+
+
+class DeadlineExceeded(requests.Timeout):
+    """
+    Raised instead of starting a request after the deadline of the run (run_deadline_seconds) has passed.
+    """
+
+
+def remaining_seconds():
+    """
+    Returns the seconds left until the deadline of the run, or None if there is no deadline.
+    """
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def start_deadline(config):
+    """
+    Starts the time given by run_deadline_seconds in OUTPUT (if set) for all requests of this run.
+    """
+    global deadline
+    seconds = config.getfloat("OUTPUT", "run_deadline_seconds", fallback=0)
+    deadline = time.monotonic() + seconds if seconds > 0 else None
+
+
+class LimitedSession(requests.Session):
+    """
+    A session whose requests all go through the rate limiter of its host and have timeouts. Requests
+    answered with 429 are repeated after Retry-After (and no other request to the host starts before),
+    GET requests are also repeated after connection problems, timeouts and server errors.
+    """
+
+    def __init__(self, limiter: ratelimit.HostLimiter):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs):
+        idempotent = method.upper() in ("GET", "HEAD")
+        timeout = kwargs.pop("timeout", None) or (connect_timeout, read_timeout)
+        throttled_attempts = 0
+        failed_attempts = 0
+        while True:
+            remaining = remaining_seconds()
+            if remaining is not None and remaining <= 0:
+                raise DeadlineExceeded(f"deadline of the run has passed, not requesting {url}")
+            try:
+                with self.limiter.slot(deadline) as waited:
+                    # waiting for the rate limit might have taken the rest of the time
+                    remaining = remaining_seconds()
+                    if remaining is not None and remaining <= 0:
+                        raise DeadlineExceeded(f"deadline of the run has passed, not requesting {url}")
+                    response = super().request(method, url, *args,
+                                               timeout=limited_timeout(timeout, remaining), **kwargs)
+            except ratelimit.DeadlineReached as e:
+                raise DeadlineExceeded(f"{e}, not requesting {url}") from e
+            except DeadlineExceeded:
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not idempotent or failed_attempts >= request_retries:
+                    raise
+                failed_attempts += 1
+                self.wait_before_retry(failed_attempts, e.__class__.__name__)
+                continue
+            throttled = response.status_code == 429
+            record_host(self.limiter.host, self.limiter.per_minute, self.limiter.burst, waited, throttled)
+            if throttled and throttled_attempts < ratelimit.THROTTLE_RETRIES:
+                throttled_attempts += 1
+                delay = ratelimit.retry_after(response.headers.get("Retry-After"), throttled_attempts)
+                logging.log(logging.INFO, f"{self.limiter.host} is throttling requests, retrying in {delay:.1f} s")
+                response.close()
+                self.limiter.pause(delay)
+            elif response.status_code in RETRIED_STATUS_CODES and idempotent and failed_attempts < request_retries:
+                failed_attempts += 1
+                response.close()
+                self.wait_before_retry(failed_attempts, f"HTTP status {response.status_code}")
+            else:
+                return response
+
+    def wait_before_retry(self, attempt: int, reason: str):
+        # the random part keeps many sections from retrying at the same moment
+        delay = random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** attempt))
+        remaining = remaining_seconds()
+        if remaining is not None:
+            delay = min(delay, max(0.0, remaining))
+        logging.debug(f"{self.limiter.host}: {reason}, retrying in {delay:.1f} s")
+        time.sleep(delay)
+
+
+def limited_timeout(timeout, remaining):
+    """
+    Shortens the (connect, read) timeout so the request can't last much longer than the deadline.
+    """
+    if remaining is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(min(value, remaining) if value is not None else remaining for value in timeout)
+    return min(timeout, remaining)
+
+
+def token_expires(token: str):
+    """
+    Returns the expiry timestamp of a JWT, or None if the token is no JWT.
+    """
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4)))
+        return float(payload["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class Login:
+    """
+    An authenticated WebUntis login which is shared by all sections using the same
+    server, school and username. It logs in lazily on first use.
+    """
+
+    def __init__(self, server: str, school: str, username: str, password: str):
+        self.server = server
+        self.school = school
+        self.username = username
+        self.password = password
+        self.session = session_for(server)
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.headers = dict()
+        self.expires = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def cache_key(self):
+        return f"{self.server}|{self.school}|{self.username}"
+
+    def ensure_logged_in(self):
+        with self.lock:
+            if self.expires is None or self.expires <= time.time():
+                if not self.load_from_cache():
+                    self.authenticate()
+                self.generation += 1
+
+    def load_from_cache(self) -> bool:
+        if auth_cache is None:
+            return False
+        entry = auth_cache.load(self.cache_key())
+        if entry is None:
+            return False
+        cookies = requests.cookies.RequestsCookieJar()
+        for cookie in entry["cookies"]:
+            cookies.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"],
+                        secure=cookie["secure"], expires=cookie["expires"])
+        self.cookies = cookies
+        self.headers = {"Authorization": f"Bearer {entry['token']}"}
+        self.expires = entry["expires"]
+        logging.debug(f"using cached login for {self.username} at {self.server}")
+        return True
+
+    def relogin(self, generation: int):
+        """
+        Called when the server rejected the login. If no other thread has logged in again
+        in the meantime, the cached login is dropped and a new one is done.
+        """
+        with self.lock:
+            if generation == self.generation:
+                if auth_cache is not None:
+                    auth_cache.forget(self.cache_key())
+                self.authenticate()
+                self.generation += 1
+
+    def authenticate(self):
+        with phase("login"):
+            response_initial = self.session.get(f'{self.server}/WebUntis/?school={self.school}')
+            if response_initial.status_code != 200:
+                raise FetchError(20, f"could not get initial page - HTTP status {response_initial.status_code}")
+            cookies = requests.cookies.RequestsCookieJar()
+            cookies.update(response_initial.cookies)
+            spring_security_response = self.session.post(f'{self.server}/WebUntis/j_spring_security_check',
+                                                         cookies=cookies,
+                                                         params={"school": self.school,
+                                                                 "j_username": self.username,
+                                                                 "j_password": self.password,
+                                                                 "token": ""})
+            if spring_security_response.status_code != 200:
+                raise FetchError(21, f"could not log in - HTTP status {spring_security_response.status_code}")
+            token_response = self.session.get(f'{self.server}/WebUntis/api/token/new', cookies=cookies)
+            if token_response.status_code != 200:
+                raise FetchError(22, f"could not get token - HTTP status {token_response.status_code}")
+            self.cookies = cookies
+            self.headers = {"Authorization": f"Bearer {token_response.text}"}
+            self.expires = time.time() + (auth_cache.ttl_seconds if auth_cache is not None else DEFAULT_LOGIN_TTL)
+            token_expiry = token_expires(token_response.text)
+            if token_expiry is not None:
+                self.expires = min(self.expires, token_expiry - 60)
+            if auth_cache is not None:
+                auth_cache.store(self.cache_key(), cookies, token_response.text)
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        path is relative to /WebUntis/ on the server - if the server doesn't accept the
+        login anymore, it is renewed and the request is repeated once
+        """
+        self.ensure_logged_in()
+        generation = self.generation
+        response = self.session.request(method, f'{self.server}/WebUntis/{path}', cookies=self.cookies,
+                                        headers=self.headers, **kwargs)
+        if response.status_code == 401:
+            logging.debug(f"login for {self.username} at {self.server} was rejected, logging in again")
+            self.relogin(generation)
+            response = self.session.request(method, f'{self.server}/WebUntis/{path}', cookies=self.cookies,
+                                            headers=self.headers, **kwargs)
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+
+# used if no auth cache is configured - logins are renewed after this many seconds
+DEFAULT_LOGIN_TTL = 15 * 60
+
+# seconds for establishing a connection and for waiting for data (connect_timeout and read_timeout in OUTPUT)
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+# GET requests are repeated this often (request_retries in OUTPUT) with a random delay of up to
+# RETRY_DELAY * 2 ^ attempt seconds, but at most MAX_RETRY_DELAY
+DEFAULT_REQUEST_RETRIES = 2
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+RETRIED_STATUS_CODES = (500, 502, 503, 504)
+
+sessions = dict()
+logins = dict()
+registry_lock = threading.RLock()
+auth_cache = None
+connect_timeout = DEFAULT_CONNECT_TIMEOUT
+read_timeout = DEFAULT_READ_TIMEOUT
+request_retries = DEFAULT_REQUEST_RETRIES
+# time.monotonic() value after which no request is started anymore, None if there is no deadline
+deadline = None
+
+
+def configure(config):
+    """
+    Sets the rate limits, timeouts and retries of all requests and the auth cache (if auth_cache_file is set).
+    """
+    global auth_cache, connect_timeout, read_timeout, request_retries
+    ratelimit.configure(config)
+    connect_timeout = config.getfloat("OUTPUT", "connect_timeout", fallback=DEFAULT_CONNECT_TIMEOUT)
+    read_timeout = config.getfloat("OUTPUT", "read_timeout", fallback=DEFAULT_READ_TIMEOUT)
+    request_retries = config.getint("OUTPUT", "request_retries", fallback=DEFAULT_REQUEST_RETRIES)
+    if config.has_option("OUTPUT", "auth_cache_file"):
+        auth_cache = AuthCache(config["OUTPUT"]["auth_cache_file"],
+                               60 * config.getint("OUTPUT", "auth_cache_minutes",
+                                                  fallback=DEFAULT_LOGIN_TTL // 60))
+    else:
+        auth_cache = None
+
+
+def session_for(url: str) -> requests.Session:
+    """
+    Returns the keep-alive session for the host of the given URL.
+    """
+    host = urlsplit(url).netloc
+    with registry_lock:
+        if host not in sessions:
+            session = LimitedSession(ratelimit.limiter_for(host))
+            session.cookies.set_policy(NoCookiesPolicy())
+            session.hooks["response"].append(record_response)
+            # sections may be fetched in parallel, so keep more than one connection per host:
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            sessions[host] = session
+        return sessions[host]
+
+
+def get_login(section_config) -> Login:
+    """
+    Returns the login for the server, school and username of the given config section.
+    """
+    key = (section_config["server"], section_config["school"], section_config["username"])
+    with registry_lock:
+        if key not in logins:
+            logins[key] = Login(section_config["server"], section_config["school"], section_config["username"],
+                                section_config["password"])
+        return logins[key]
+
+
+def close_all():
+    """
+    Closes all sessions and forgets all logins.
+    """
+    with registry_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+        logins.clear()
@@ -0,0 +1,34 @@
+import time
+
+from webuntis_fetcher.files import JsonCache
+
+
+class SnapshotStore(JsonCache):
+    """
+    Keeps the HTML of the last successful rendering of each section in memory and, if a filename is
+    configured, in a file, so a section which can't be fetched can show its last state instead.
+    """
+
+    def __init__(self):
+        super().__init__("snapshot file")
+
+    def get(self, section: str):
+        """
+        Returns the last entry of the section ({"html": ..., "stored": timestamp}) or None.
+        """
+        with self.lock:
+            self.read()
+            return self.entries.get(section)
+
+    def put(self, section: str, html: str):
+        with self.lock:
+            self.read()
+            self.entries[section] = {"html": html, "stored": time.time()}
+            self.changed = True
+
+
+store = SnapshotStore()
+
+
+def configure(config):
+    store.configure(config.get("OUTPUT", "snapshot_file", fallback=None))
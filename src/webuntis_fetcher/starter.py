@@ -3,13 +3,37 @@ import logging
 import os
 import sys
 
-from webuntis_fetcher import timetable, messages
+from webuntis_fetcher import metrics
+
+MODES = ("timetable", "messages", "export-statistics", "watch", "replay")
+
+
+def load_mode(mode: str):
+    """
+    Imports only the modules the given mode needs and returns its run function.
+    """
+    if mode == "timetable":
+        from webuntis_fetcher import timetable
+        return timetable.run
+    elif mode == "messages":
+        from webuntis_fetcher import messages
+        return messages.run
+    elif mode == "export-statistics":
+        from webuntis_fetcher import timetable
+        return timetable.export_statistics
+    elif mode == "watch":
+        from webuntis_fetcher import watch
+        return watch.run
+    elif mode == "replay":
+        from webuntis_fetcher import timetable
+        return timetable.replay
 
 
 def run():
-    if len(sys.argv) < 2 or sys.argv[1] not in ("timetable", "messages"):
+    if len(sys.argv) < 2 or sys.argv[1] not in MODES:
         logging.log(logging.ERROR, "wrong arguments, here's some guidance:\n"
-                                   "  1. mode (required) - either 'timetable' or 'messages'\n"
+                                   "  1. mode (required) - 'timetable', 'messages', 'export-statistics', 'watch'\n"
+                                   "     or 'replay'\n"
                                    "  2. config file (optional) - not not provided, 'config.ini' is used")
         exit(1)
     mode = sys.argv[1]
@@ -22,10 +46,19 @@ def run():
     if not os.path.isfile(config_file):
         logging.log(logging.ERROR, f"{config_file} not found")
         exit(1)
+    mode_run = load_mode(mode)
+    if mode == "watch":
+        mode_run(config_file)
+        return
     config = configparser.ConfigParser()
     config.read(config_file)
-
-    if mode == "timetable":
-        timetable.run(config)
-    elif mode == "messages":
-        messages.run(config)
+    # these modes don't access the network
+    if mode not in ("export-statistics", "replay"):
+        from webuntis_fetcher import session
+        session.configure(config)
+        session.start_deadline(config)
+    metrics.start(mode)
+    try:
+        mode_run(config)
+    finally:
+        metrics.report(config)
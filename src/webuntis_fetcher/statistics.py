@@ -1,19 +1,107 @@
+import datetime
 import os
+import sqlite3
+import sys
 import warnings
+from collections import namedtuple
 
-from openpyxl.reader.excel import load_workbook as load_workbook
-from openpyxl import Workbook
-from openpyxl.styles import Alignment
+from webuntis_fetcher.metrics import phase
+
+
+# values of the is_cancelled column which mean "not cancelled" (older files contain formulas and strings)
+NOT_CANCELLED = (False, "=FALSE()", "=FALSE", "FALSE", "False")
+
+# dimensions of the rollups, "total" has only the key ""
+DIMENSIONS = ("total", "teacher", "subject", "weekday", "month")
+
+
+# one recorded lesson - a tuple instead of a dict per row to keep long histories small in memory
+Lesson = namedtuple("Lesson", ["planned_teacher", "planned_subject", "actual_teacher", "actual_subject",
+                               "is_cancelled", "comment"])
+
+
+def is_cancelled_value(value) -> bool:
+    return value not in NOT_CANCELLED
+
+
+def intern(value):
+    """
+    Teacher and subject names repeat a lot, so all lessons share one string object per name.
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def lesson(planned_teacher, planned_subject, actual_teacher, actual_subject, is_cancelled, comment) -> Lesson:
+    return Lesson(intern(planned_teacher), intern(planned_subject), intern(actual_teacher), intern(actual_subject),
+                  is_cancelled_value(is_cancelled), comment)
+
+
+def counts_of(entry: Lesson) -> tuple:
+    """
+    Returns the contribution of one lesson to the counts: (all, cancelled, changed teacher, changed subject).
+    """
+    if entry.is_cancelled:
+        return 1, 1, 0, 0
+    return (1, 0,
+            1 if entry.planned_teacher != entry.actual_teacher else 0,
+            1 if entry.planned_subject != entry.actual_subject else 0)
+
+
+def rollup_keys(timestamp: datetime.datetime, entry: Lesson) -> tuple:
+    """
+    Returns the (dimension, key) pairs one lesson is counted for.
+    """
+    return (("total", ""),
+            ("teacher", entry.planned_teacher or ""),
+            ("subject", entry.planned_subject or ""),
+            ("weekday", str(timestamp.weekday())),
+            ("month", timestamp.strftime("%Y-%m")))
+
+
+class Aggregates:
+    """
+    Running counts (all, cancelled, changed teacher, changed subject) in total and per teacher, subject,
+    weekday (0 = Monday) and month (YYYY-MM). Replacing a lesson only changes the counts by the difference.
+    """
+
+    def __init__(self):
+        self.counts = dict()
+
+    def add(self, timestamp: datetime.datetime, entry: Lesson, sign: int = 1):
+        contribution = counts_of(entry)
+        for key in rollup_keys(timestamp, entry):
+            counts = self.counts.setdefault(key, [0, 0, 0, 0])
+            for index in range(4):
+                counts[index] += sign * contribution[index]
+
+    def remove(self, timestamp: datetime.datetime, entry: Lesson):
+        self.add(timestamp, entry, -1)
+
+    def total(self) -> list:
+        return self.counts.get(("total", ""), [0, 0, 0, 0])
+
+    def rollup(self, dimension: str) -> dict:
+        """
+        Returns key -> (all, cancelled, changed teacher, changed subject) for the given dimension.
+        """
+        return {key: tuple(counts) for (counts_dimension, key), counts in self.counts.items()
+                if counts_dimension == dimension and counts[0]}
 
 
 class Statistics:
     """
     Keeps track of changed and cancelled lessons. Use separate instances for each timetable to track.
+    The data sheet is only read (in read-only streaming mode) when it is needed: the summary can be
+    taken from the statistics sheet as long as no lessons were added.
 
     **data sheet columns**: timestamp, planned_teacher, planned_subject, actual_teacher, actual_subject,
     is_cancelled, comment
 
-    **statistics sheet columns**: percentage_changed_teacher, percentage_changed_subject, percentage_cancelled
+    **statistics sheet columns**: percentage_changed_teacher, percentage_changed_subject, percentage_cancelled,
+    count_all, count_changed_teacher, count_changed_subject, count_cancelled, earliest_date
+
+    **rollups sheet columns**: dimension (teacher, subject, weekday with 0 = Monday, month), key, count_all,
+    count_cancelled, count_changed_teacher, count_changed_subject, percentage_cancelled
     """
 
     def __init__(self, filename, title):
@@ -21,14 +109,37 @@ class Statistics:
         self.workbook_filename = None
         self.title = title
         self.data = dict()
-        self.count_all = 0
-        self.count_changed_teacher = 0
-        self.count_changed_subject = 0
-        self.count_cancelled = 0
+        self.aggregates = Aggregates()
+        self.loaded = False
+        self.pending = dict()
+        self.summary = None
+
+    @property
+    def count_all(self):
+        return self.total()[0]
+
+    @property
+    def count_cancelled(self):
+        return self.total()[1]
+
+    @property
+    def count_changed_teacher(self):
+        return self.total()[2]
 
+    @property
+    def count_changed_subject(self):
+        return self.total()[3]
+
+    def total(self):
+        if not self.loaded and not self.pending and self.summary is not None:
+            return self.summary[:4]
+        self.load()
+        return self.aggregates.total()
+
+    @phase("statistics_open")
     def open(self):
         """
-        Reads the existing data, if any.
+        Reads the summary of the existing data, if any.
         """
         warnings.filterwarnings(action="ignore",
                                 message="Title is more than 31 characters. Some applications may not be able to read "
@@ -37,45 +148,75 @@ class Statistics:
 
         self.workbook_filename = os.path.realpath(self.filename)
         if os.path.isfile(self.workbook_filename):
-            workbook = load_workbook(self.workbook_filename)
-            datasheet = workbook[self.title]
-            if datasheet is not None:
-                for row in datasheet.iter_rows(min_row=2, max_col=7, values_only=True):
-                    if row[0] is None:
-                        break
-                    self.data[row[0]] = {"planned_teacher": row[1],
-                                         "planned_subject": row[2],
-                                         "actual_teacher": row[3],
-                                         "actual_subject": row[4],
-                                         "is_cancelled": row[5],
-                                         "comment": row[6]}
+            # openpyxl takes a while to import, so it's only done when needed
+            from openpyxl.reader.excel import load_workbook
+            workbook = load_workbook(self.workbook_filename, read_only=True)
+            try:
+                if f"{self.title} - Statistics" in workbook.sheetnames:
+                    for row in workbook[f"{self.title} - Statistics"].iter_rows(min_row=2, max_row=2, max_col=8,
+                                                                               values_only=True):
+                        if len(row) >= 8 and row[3] is not None and row[7] is not None:
+                            # all, cancelled, changed teacher, changed subject, earliest date
+                            self.summary = (row[3], row[6], row[4], row[5], row[7])
+            finally:
+                workbook.close()
 
-    def save(self):
+    def load(self):
+        """
+        Reads all existing lessons (if open() found a file), if not done yet.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        with phase("statistics_load"):
+            if self.workbook_filename is not None and os.path.isfile(self.workbook_filename):
+                from openpyxl.reader.excel import load_workbook
+                workbook = load_workbook(self.workbook_filename, read_only=True)
+                try:
+                    if self.title in workbook.sheetnames:
+                        for row in workbook[self.title].iter_rows(min_row=2, max_col=7, values_only=True):
+                            if row[0] is None:
+                                break
+                            self.store(row[0], lesson(*row[1:7]))
+                finally:
+                    workbook.close()
+            for timestamp, entry in self.pending.items():
+                self.store(timestamp, entry)
+            self.pending.clear()
+
+    def store(self, timestamp, entry: Lesson):
+        if timestamp in self.data:
+            self.aggregates.remove(timestamp, self.data[timestamp])
+        self.data[timestamp] = entry
+        self.aggregates.add(timestamp, entry)
+
+    def lessons(self):
+        """
+        Yields (timestamp, lesson) for all lessons.
+        """
+        self.load()
+        yield from self.data.items()
+
+    @phase("statistics_save")
+    def save(self, rollups: dict = None):
+        """
+        Writes the workbook. The rollups (dimension -> result of rollup()) are taken from the lessons if not given.
+        """
+        from openpyxl import Workbook
+        from openpyxl.styles import Alignment
+        self.load()
         workbook = Workbook()
         workbook.remove_sheet(workbook.active)
         datasheet = workbook.create_sheet(self.title)
         datasheet.append(["timestamp", "planned_teacher", "planned_subject", "actual_teacher", "actual_subject",
                           "is_cancelled", "comment"])
         statsheet = workbook.create_sheet(f"{self.title} - Statistics")
-        statsheet.append(["percentage_changed_teacher", "percentage_changed_subject", "percentage_cancelled"])
-
-        self.count_all = 0
-        self.count_changed_teacher = 0
-        self.count_changed_subject = 0
-        self.count_cancelled = 0
+        statsheet.append(["percentage_changed_teacher", "percentage_changed_subject", "percentage_cancelled",
+                          "count_all", "count_changed_teacher", "count_changed_subject", "count_cancelled",
+                          "earliest_date"])
 
         for timestamp in sorted(self.data.keys()):
-            entry = self.data[timestamp]
-            datasheet.append([timestamp, entry["planned_teacher"], entry["planned_subject"], entry["actual_teacher"],
-                              entry["actual_subject"], entry["is_cancelled"], entry["comment"]])
-            self.count_all += 1
-            if entry["is_cancelled"] not in (False, "=FALSE()", "=FALSE", "FALSE", "False"):
-                self.count_cancelled += 1
-            else:
-                if entry["planned_teacher"] != entry["actual_teacher"]:
-                    self.count_changed_teacher += 1
-                if entry["planned_subject"] != entry["actual_subject"]:
-                    self.count_changed_subject += 1
+            datasheet.append([timestamp, *self.data[timestamp]])
         for cell in datasheet["A"]:
             cell.alignment = Alignment(horizontal='left')
             cell.number_format = 'YYYY-MM-DD HH:MM:SS'
@@ -85,27 +226,230 @@ class Statistics:
 
         statsheet.append([self.count_changed_teacher / self.count_all,
                           self.count_changed_subject / self.count_all,
-                          self.count_cancelled / self.count_all])
+                          self.count_cancelled / self.count_all,
+                          self.count_all,
+                          self.count_changed_teacher,
+                          self.count_changed_subject,
+                          self.count_cancelled,
+                          self.earliest_date()])
         statsheet["A2"].number_format = '0.00" "%'
         statsheet["B2"].number_format = '0.00" "%'
         statsheet["C2"].number_format = '0.00" "%'
+        statsheet["H2"].number_format = 'YYYY-MM-DD HH:MM:SS'
         for column_cells in statsheet.columns:
             length = max(len(str(cell.value)) for cell in column_cells) + 3
             statsheet.column_dimensions[column_cells[0].column_letter].width = length
+
+        rollupsheet = workbook.create_sheet(f"{self.title} - Rollups")
+        rollupsheet.append(["dimension", "key", "count_all", "count_cancelled", "count_changed_teacher",
+                            "count_changed_subject", "percentage_cancelled"])
+        for dimension in DIMENSIONS[1:]:
+            counts_by_key = rollups[dimension] if rollups is not None else self.rollup(dimension)
+            for key, counts in sorted(counts_by_key.items()):
+                rollupsheet.append([dimension, key, *counts, counts[1] / counts[0]])
+        for cell in rollupsheet["G"][1:]:
+            cell.number_format = '0.00" "%'
         workbook.save(os.path.realpath(self.filename))
 
+    def close(self):
+        """
+        Nothing to do, the workbook is only opened while reading and saving.
+        """
+        pass
+
+    def put(self, timestamp, planned_teacher, planned_subject, actual_teacher=None, actual_subject=None,
+            is_cancelled=None, comment=None):
+        if planned_teacher or planned_subject or actual_teacher or actual_subject:
+            entry = lesson(planned_teacher, planned_subject, actual_teacher, actual_subject, is_cancelled, comment)
+            if self.loaded:
+                self.store(timestamp, entry)
+            else:
+                self.pending[timestamp] = entry
+
+    def rollup(self, dimension: str) -> dict:
+        """
+        Returns the counts per key of the dimension, see Aggregates.
+        """
+        self.load()
+        return self.aggregates.rollup(dimension)
+
+    def earliest_date(self):
+        if not self.loaded and not self.pending and self.summary is not None:
+            return self.summary[4]
+        self.load()
+        return min(self.data.keys())
+
+    def percentage_cancelled(self):
+        return self.count_cancelled / self.count_all
+
+    def percentage_changed_subject(self):
+        return self.count_changed_subject / self.count_all
+
+    def percentage_changed_teacher(self):
+        return self.count_changed_teacher / self.count_all
+
+
+class SqliteStatistics:
+    """
+    Keeps track of changed and cancelled lessons in an SQLite database, so a run only has to write
+    the lessons it has seen instead of the whole history. One database can hold multiple timetables,
+    they are separated by their title. The XLSX file is only an export (see export()).
+
+    **lesson table columns**: title, timestamp, planned_teacher, planned_subject, actual_teacher,
+    actual_subject, is_cancelled, comment
+
+    **rollup table columns**: title, dimension, key, count_all, count_cancelled, count_changed_teacher,
+    count_changed_subject - updated by difference when lessons are saved, see Aggregates
+    """
+
+    def __init__(self, filename, title):
+        self.filename = filename
+        self.title = title
+        self.connection = None
+        self.pending = dict()
+        self.count_all = 0
+        self.count_changed_teacher = 0
+        self.count_changed_subject = 0
+        self.count_cancelled = 0
+
+    @phase("statistics_open")
+    def open(self):
+        """
+        Opens the database and creates the tables if necessary.
+        """
+        self.connection = sqlite3.connect(os.path.realpath(self.filename), timeout=30)
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS lesson (
+                                           title TEXT NOT NULL,
+                                           timestamp TEXT NOT NULL,
+                                           planned_teacher TEXT,
+                                           planned_subject TEXT,
+                                           actual_teacher TEXT,
+                                           actual_subject TEXT,
+                                           is_cancelled INTEGER,
+                                           comment TEXT,
+                                           PRIMARY KEY (title, timestamp))""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS rollup (
+                                           title TEXT NOT NULL,
+                                           dimension TEXT NOT NULL,
+                                           key TEXT NOT NULL,
+                                           count_all INTEGER NOT NULL,
+                                           count_cancelled INTEGER NOT NULL,
+                                           count_changed_teacher INTEGER NOT NULL,
+                                           count_changed_subject INTEGER NOT NULL,
+                                           PRIMARY KEY (title, dimension, key))""")
+            if self.read_total() is None:
+                # database from a version without rollups - compute them once
+                aggregates = Aggregates()
+                for timestamp, entry in self.lessons():
+                    aggregates.add(timestamp, entry)
+                self.write_rollups(aggregates)
+        self.count_all, self.count_cancelled, self.count_changed_teacher, self.count_changed_subject = \
+            self.read_total() or (0, 0, 0, 0)
+
+    def read_total(self):
+        return self.connection.execute("""SELECT count_all, count_cancelled, count_changed_teacher,
+                                                 count_changed_subject
+                                          FROM rollup WHERE title = ? AND dimension = 'total'""",
+                                       (self.title,)).fetchone()
+
+    def write_rollups(self, delta: Aggregates):
+        self.connection.executemany("""INSERT INTO rollup
+                                       (title, dimension, key, count_all, count_cancelled, count_changed_teacher,
+                                        count_changed_subject)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?)
+                                       ON CONFLICT (title, dimension, key) DO UPDATE SET
+                                       count_all = count_all + excluded.count_all,
+                                       count_cancelled = count_cancelled + excluded.count_cancelled,
+                                       count_changed_teacher = count_changed_teacher + excluded.count_changed_teacher,
+                                       count_changed_subject = count_changed_subject + excluded.count_changed_subject""",
+                                    [(self.title, dimension, key, *counts)
+                                     for (dimension, key), counts in delta.counts.items()]
+                                    + [(self.title, "total", "", 0, 0, 0, 0)])
+
+    def lessons(self, timestamp=None):
+        """
+        Yields (timestamp, entry) for all lessons of this timetable, or only for the given timestamp.
+        """
+        query = """SELECT timestamp, planned_teacher, planned_subject, actual_teacher, actual_subject,
+                          is_cancelled, comment
+                   FROM lesson WHERE title = ?"""
+        parameters = (self.title,)
+        if timestamp is not None:
+            query += " AND timestamp = ?"
+            parameters = (self.title, timestamp.isoformat(sep=" "))
+        for row in self.connection.execute(query, parameters):
+            yield datetime.datetime.fromisoformat(row[0]), lesson(*row[1:6], comment=row[6])
+
+    @phase("statistics_save")
+    def save(self):
+        """
+        Writes the lessons given to put() since the last save and updates the rollups by the difference.
+        """
+        delta = Aggregates()
+        with self.connection:
+            for timestamp, entry in self.pending.items():
+                for _, old_entry in self.lessons(timestamp):
+                    delta.remove(timestamp, old_entry)
+                delta.add(timestamp, entry)
+            self.connection.executemany("""INSERT OR REPLACE INTO lesson
+                                           (title, timestamp, planned_teacher, planned_subject, actual_teacher,
+                                            actual_subject, is_cancelled, comment)
+                                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                                        [(self.title, timestamp.isoformat(sep=" "), *entry)
+                                         for timestamp, entry in self.pending.items()])
+            self.write_rollups(delta)
+        self.pending.clear()
+        self.count_all, self.count_cancelled, self.count_changed_teacher, self.count_changed_subject = \
+            self.read_total()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
     def put(self, timestamp, planned_teacher, planned_subject, actual_teacher=None, actual_subject=None,
             is_cancelled=None, comment=None):
         if planned_teacher or planned_subject or actual_teacher or actual_subject:
-            self.data[timestamp] = {"planned_teacher": planned_teacher,
-                                    "planned_subject": planned_subject,
-                                    "actual_teacher": actual_teacher,
-                                    "actual_subject": actual_subject,
-                                    "is_cancelled": is_cancelled,
-                                    "comment": comment}
+            self.pending[timestamp] = lesson(planned_teacher, planned_subject, actual_teacher, actual_subject,
+                                             is_cancelled, comment)
+
+    def rollup(self, dimension: str) -> dict:
+        """
+        Returns the counts per key of the dimension, see Aggregates.
+        """
+        return {row[0]: tuple(row[1:])
+                for row in self.connection.execute("""SELECT key, count_all, count_cancelled, count_changed_teacher,
+                                                             count_changed_subject
+                                                      FROM rollup
+                                                      WHERE title = ? AND dimension = ? AND count_all > 0""",
+                                                   (self.title, dimension))}
+
+    @phase("statistics_import")
+    def import_from(self, filename):
+        """
+        Takes over all lessons of this timetable from an XLSX file written by Statistics.
+        """
+        statistics = Statistics(filename, self.title)
+        statistics.open()
+        self.pending.update(statistics.lessons())
+        self.save()
+
+    @phase("statistics_export")
+    def export(self, filename):
+        """
+        Writes all lessons of this timetable to an XLSX file in the format of Statistics (replacing its content).
+        """
+        statistics = Statistics(filename, self.title)
+        for timestamp, entry in self.lessons():
+            statistics.put(timestamp, *entry)
+        if statistics.pending:
+            # the rollups are already in the database
+            statistics.save({dimension: self.rollup(dimension) for dimension in DIMENSIONS[1:]})
 
     def earliest_date(self):
-        return sorted(self.data.keys())[0]
+        return datetime.datetime.fromisoformat(
+            self.connection.execute("SELECT MIN(timestamp) FROM lesson WHERE title = ?", (self.title,)).fetchone()[0])
 
     def percentage_cancelled(self):
         return self.count_cancelled / self.count_all
@@ -115,3 +459,24 @@ class Statistics:
 
     def percentage_changed_teacher(self):
         return self.count_changed_teacher / self.count_all
+
+
+def is_sqlite_file(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in (".db", ".sqlite", ".sqlite3")
+
+
+def create_statistics(filename, title):
+    """
+    Returns the statistics backend matching the file name: SQLite for .db/.sqlite/.sqlite3, else XLSX.
+    """
+    if is_sqlite_file(filename):
+        return SqliteStatistics(filename, title)
+    return Statistics(filename, title)
+
+
+def export_due(filename: str, interval_hours: float) -> bool:
+    """
+    Checks if the export file is missing or older than the given interval.
+    """
+    return (not os.path.isfile(filename)
+            or datetime.datetime.now().timestamp() - os.path.getmtime(filename) >= interval_hours * 3600)
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+
+from webuntis_fetcher.files import read_json, write_json
+from webuntis_fetcher.session import session_for
+
+DEFAULT_CACHE_HOURS = 24
+# the staff page of a school might be slow, but it must not block the timetable for long
+REQUEST_TIMEOUT = 30
+# after a failed fetch without any cached map, the next try is done after this many seconds
+RETRY_SECONDS = 600
+
+# name (as used in teacher_fullname_function) -> function which returns a dict: abbreviation -> full name
+resolvers = dict()
+
+cache_file = None
+max_age_seconds = DEFAULT_CACHE_HOURS * 3600
+# set by the watch mode: outdated maps are still used while a new one is fetched in the background
+refresh_in_background = False
+# set by the replay mode: only names which are already cached are used
+offline = False
+
+lock = threading.Lock()
+# name -> {"fetched": timestamp, "names": dict}, shared by all sections using the same resolver
+maps = dict()
+# name -> time of the last fetch (successful or not)
+attempts = dict()
+refreshing = set()
+resolver_locks = dict()
+
+
+def resolver(function):
+    """
+    Registers a function under its name so it can be used as teacher_fullname_function.
+    """
+    resolvers[function.__name__] = function
+    return function
+
+
+@resolver
+def kks_kannover_teachers() -> dict:
+    # BeautifulSoup is only needed here, so it's imported when this function is configured
+    from bs4 import BeautifulSoup
+    url = "https://www.kks-hannover.de/ueber-uns/personen/kollegium/"
+    response = session_for(url).get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+    soup = BeautifulSoup(response.text, features="html.parser")
+    table = soup.find("table")
+
+    headings = [th.get_text() for th in table.find("tr").find_all("th")]
+    index_of_lastname = headings.index("Nachname")
+    index_of_abbreviation = headings.index("Kürzel")
+
+    # some teachers are not on the web site:
+    abbrev_to_name = {"HAT": "Hatala", "PAP": "Pape", "VER": "Verwolt", "JK": "Junitz-Kofeld", "PFL": "Pflanz",
+                      "BEJ": "Berger"}
+    for row in table.find_all("tr")[1:]:
+        row_data = [td.get_text() for td in row.find_all("td")]
+        abbrev_to_name[row_data[index_of_abbreviation]] = row_data[index_of_lastname]
+    return abbrev_to_name
+
+
+def configure(config):
+    """
+    Sets the cache file and the maximum age of the teacher names (teacher_cache_file, teacher_cache_hours).
+    """
+    global cache_file, max_age_seconds
+    cache_file = config.get("OUTPUT", "teacher_cache_file", fallback=None)
+    max_age_seconds = 3600 * config.getfloat("OUTPUT", "teacher_cache_hours", fallback=DEFAULT_CACHE_HOURS)
+
+
+def fetch(name: str):
+    """
+    Calls the resolver and keeps its result. If it fails, the last map (if any) stays in use.
+    """
+    with lock:
+        attempts[name] = time.time()
+    try:
+        names = resolvers[name]()
+    except Exception as e:
+        logging.log(logging.WARNING, f"could not get teacher names from {name}, using the last ones: {e}")
+        return
+    with lock:
+        maps[name] = {"fetched": time.time(), "names": names}
+        if cache_file is not None:
+            write_json(cache_file, maps, "teacher cache")
+
+
+def due(name: str) -> bool:
+    """
+    Checks if the map is older than teacher_cache_hours (or missing) and the last try isn't too recent.
+    """
+    entry = maps.get(name)
+    return ((entry is None or time.time() - entry["fetched"] >= max_age_seconds)
+            and time.time() - attempts.get(name, 0) >= RETRY_SECONDS)
+
+
+def refresh(name: str):
+    try:
+        fetch(name)
+    finally:
+        with lock:
+            refreshing.discard(name)
+
+
+def full_names(name: str) -> dict:
+    """
+    Returns the abbreviation -> full name map of the named resolver. It's taken from memory or the
+    cache file as long as it's younger than teacher_cache_hours, else it's fetched again.
+    """
+    if name not in resolvers:
+        logging.log(logging.ERROR, f"unknown teacher_fullname_function {name} - "
+                                   f"available: {', '.join(sorted(resolvers))}")
+        return dict()
+    with lock:
+        if name not in maps:
+            cached = read_json(cache_file, "teacher cache").get(name)
+            if cached is not None:
+                maps[name] = cached
+        if offline:
+            return maps[name]["names"] if name in maps else dict()
+        if due(name) and name in maps and refresh_in_background:
+            if name not in refreshing:
+                refreshing.add(name)
+                threading.Thread(target=refresh, args=(name,), daemon=True).start()
+            return maps[name]["names"]
+        name_lock = resolver_locks.setdefault(name, threading.Lock())
+    # sections are rendered in parallel, but only one of them fetches the map
+    with name_lock:
+        if due(name):
+            fetch(name)
+    entry = maps.get(name)
+    return entry["names"] if entry is not None else dict()
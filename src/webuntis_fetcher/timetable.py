@@ -1,73 +1,22 @@
 #!/usr/bin/env python3
 import datetime
+import json
 import logging
+import os
+import re
 import sys
-from io import TextIOWrapper
-from typing import TextIO
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
 
 import requests
-from bs4 import BeautifulSoup
 
-from webuntis_fetcher.statistics import Statistics
-
-
-def kks_kannover_teachers() -> dict:
-    html = requests.get("https://www.kks-hannover.de/ueber-uns/personen/kollegium/").text
-
-    soup = BeautifulSoup(html, features="html.parser")
-    table = soup.find("table")
-
-    headings = [th.get_text() for th in table.find("tr").find_all("th")]
-    index_of_lastname = headings.index("Nachname")
-    index_of_abbreviation = headings.index("Kürzel")
-
-    # some teachers are not on the web site:
-    abbrev_to_name = {"HAT": "Hatala", "PAP": "Pape", "VER": "Verwolt", "JK": "Junitz-Kofeld", "PFL": "Pflanz",
-                      "BEJ": "Berger"}
-    for row in table.find_all("tr")[1:]:
-        row_data = [td.get_text() for td in row.find_all("td")]
-        abbrev_to_name[row_data[index_of_abbreviation]] = row_data[index_of_lastname]
-    return abbrev_to_name
-
-
-def get_element_name(elements: dict, element_type: int, element_id: int):
-    """
-    type: 1=class/group, 2=teacher, 3=subject, 4=room, 5=student
-    """
-    for element in elements:
-        if element["type"] == element_type and element["id"] == element_id:
-            if element_type == 1:
-                return element["displayname"]
-            elif element_type == 2:
-                return element["name"]
-            elif element_type == 3:
-                return element["displayname"]
-            elif element_type == 4:
-                return element["displayname"]
-            elif element_type == 5:
-                return element["displayname"]
-    return None
-
-
-def get_element_id_list(elements: dict, element_type: int, attribute: str = "id"):
-    element_ids = list()
-    for element in elements:
-        if element["type"] == element_type:
-            element_ids.append(element[attribute])
-    return sorted(element_ids)
-
-
-def write(target: TextIO, line: str):
-    target.write(line + "\n")
-
-
-def get_next_key(base: dict, this_key: datetime.time):
-    last_key = None
-    for key in sorted(base.keys()):
-        if last_key == this_key:
-            return key
-        last_key = key
-    return None
+from webuntis_fetcher import archive, metadata, render, snapshots, teachers
+from webuntis_fetcher.files import replace_file
+from webuntis_fetcher.fingerprints import fingerprint, load_fingerprints, save_fingerprints
+from webuntis_fetcher.layout import layout
+from webuntis_fetcher.metrics import bind, phase
+from webuntis_fetcher.periods import parse_periods, parse_time
+from webuntis_fetcher.session import FetchError, get_login
 
 
 def add_entry(data_dict: dict, category: str, kind: str, element: str):
@@ -81,74 +30,152 @@ def add_entry(data_dict: dict, category: str, kind: str, element: str):
         data_dict[category][kind] = element
 
 
-def get_data_direct(section_config, week_start_date, target):
-    statistics = None
-    if "statistics_file" in section_config:
-        statistics = Statistics(section_config["statistics_file"],
-                                f'{section_config["firstname"]} {section_config["lastname"]} - {section_config["class"]}')
-        statistics.open()
-    response_initial = requests.get(f'{section_config["server"]}/WebUntis/?school={section_config["school"]}')
-    if response_initial.status_code != 200:
-        exit(20)
-    cookies = response_initial.cookies
-    spring_security_response = requests.post(f'{section_config["server"]}/WebUntis/j_spring_security_check', cookies=cookies,
-                  params={"school": section_config["school"],
-                          "j_username": section_config["username"],
-                          "j_password": section_config["password"],
-                          "token": ""})
-    if spring_security_response.status_code != 200:
-        exit(21)
-    token_response = requests.get(f'{section_config["server"]}/WebUntis/api/token/new', cookies=cookies)
-    if token_response.status_code != 200:
-        exit(22)
-    headers = {"Authorization": f"Bearer {token_response.text}"}
-
-    if "class" in section_config:
-        response_pageconfig = requests.get(
-            f'{section_config["server"]}/WebUntis/api/public/timetable/weekly/pageconfig'
-            f'?type=5&date={week_start_date}&isMyTimetableSelected=false', cookies=cookies,
-            headers=headers)
-    else:
-        response_pageconfig = requests.get(
-            f'{section_config["server"]}/WebUntis/api/public/timetable/weekly/pageconfig'
-            f'?type=2&date={week_start_date}&isMyTimetableSelected=true', cookies=cookies,
-            headers=headers)
+def fetch_person_id(login, section_config, week_start_date: datetime.date) -> tuple:
+    """
+    Returns the person id from the pageconfig (None if the person wasn't found) and the archive hash of it.
+    """
+    with phase("pageconfig"):
+        if "class" in section_config:
+            response_pageconfig = login.get(
+                'api/public/timetable/weekly/pageconfig'
+                f'?type=5&date={week_start_date}&isMyTimetableSelected=false')
+        else:
+            response_pageconfig = login.get(
+                'api/public/timetable/weekly/pageconfig'
+                f'?type=2&date={week_start_date}&isMyTimetableSelected=true')
     if response_pageconfig.status_code != 200:
-        exit(23)
+        raise FetchError(23, f"could not get pageconfig - HTTP status {response_pageconfig.status_code}")
     pageconfig = response_pageconfig.json()
-    person_id = None
+    digest = archive.store(response_pageconfig.content)
     for person in pageconfig["data"]["elements"]:
         if person["forename"] == section_config["firstname"] and person["longName"] == section_config["lastname"]:
-            person_id = person["id"]
-            break
-    if "class" in section_config:
-        response_week_data = requests.get(f'{section_config["server"]}/WebUntis/api/public/timetable/weekly/data'
-                                          f'?elementType=5&elementId={person_id}&date={week_start_date}&formatId=1',
-                                          cookies=cookies, headers=headers)
-    else:
-        response_week_data = requests.get(f'{section_config["server"]}/WebUntis/api/public/timetable/weekly/data'
-                                          f'?elementType=2&elementId={person_id}&date={week_start_date}&formatId=9',
-                                          cookies=cookies, headers=headers)
-    if response_week_data.status_code != 200:
-        exit(24)
-    week_data = response_week_data.json()
-
-    if "data" not in week_data or "result" not in week_data["data"]:
-        return
+            return person["id"], digest
+    return None, digest
+
+
+def timegrid_rows(timegrid: dict) -> list:
+    return [{"startTime": row["startTime"], "endTime": row["endTime"]} for row in timegrid["data"]["rows"]]
 
-    days = [week_start_date + datetime.timedelta(days=x) for x in range(5)]
-    periods_by_time = dict()
 
-    if "class" in section_config:
-        response_timegrid = requests.get(f'{section_config["server"]}/WebUntis/api/public/timegrid',
-                                         cookies=cookies, headers=headers)
-        if response_timegrid.status_code != 200:
-            exit(25)
-        timegrid = response_timegrid.json()
+def fetch_timegrid_rows(login) -> tuple:
+    """
+    Returns the start and end times of the timegrid and the archive hash of it.
+    """
+    with phase("timegrid"):
+        response_timegrid = login.get('api/public/timegrid')
+    if response_timegrid.status_code != 200:
+        raise FetchError(25, f"could not get timegrid - HTTP status {response_timegrid.status_code}")
+    return timegrid_rows(response_timegrid.json()), archive.store(response_timegrid.content)
+
 
+def fetch_data(section_config, week_start_dates: list, workers: int = 1) -> dict:
+    """
+    Gets the raw data of the given weeks from WebUntis: the person id, the weekly data of each
+    week (fetched in parallel, keyed by the ISO date of the week's Monday) and (in student mode)
+    the timegrid. Person id and timegrid rarely change, so they are taken from the metadata cache
+    if possible, else they are only requested once for all weeks. If a cached person id returns
+    no data, it's looked up again once.
+    """
+    login = get_login(section_config)
+    first_week_start_date = week_start_dates[0]
+    cache_key = metadata.key_of(section_config)
+    # hashes of the archived responses (if archive_dir is configured)
+    archived = {"pageconfig": None, "timegrid": None, "weeks": dict()}
+
+    def look_up_person_id():
+        found_id, archived["pageconfig"] = fetch_person_id(login, section_config, first_week_start_date)
+        if found_id is None:
+            raise FetchError(23, f'could not find {section_config["firstname"]} {section_config["lastname"]}'
+                                 ' in the pageconfig')
+        metadata.cache.put(cache_key, "person_id", found_id)
+        return found_id
+
+    try:
+        person_id = metadata.cache.get(cache_key, "person_id")
+        cached_person_id = person_id
+        if person_id is None:
+            person_id = look_up_person_id()
+
+        def fetch_week(week_start_date: datetime.date) -> dict:
+            with phase("weekly_data"):
+                if "class" in section_config:
+                    response_week_data = login.get('api/public/timetable/weekly/data'
+                                                   f'?elementType=5&elementId={person_id}&date={week_start_date}'
+                                                   '&formatId=1')
+                else:
+                    response_week_data = login.get('api/public/timetable/weekly/data'
+                                                   f'?elementType=2&elementId={person_id}&date={week_start_date}'
+                                                   '&formatId=9')
+            if response_week_data.status_code != 200:
+                raise FetchError(24, f"could not get weekly data - HTTP status {response_week_data.status_code}")
+            archived["weeks"][week_start_date.isoformat()] = archive.store(response_week_data.content)
+            return response_week_data.json()
+
+        def fetch_weeks() -> list:
+            if len(week_start_dates) == 1:
+                return [fetch_week(first_week_start_date)]
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(week_start_dates)))) as executor:
+                return list(executor.map(bind(fetch_week), week_start_dates))
+
+        try:
+            weeks = fetch_weeks()
+        except FetchError:
+            if cached_person_id is None:
+                raise
+            weeks = None
+        if cached_person_id is not None and (weeks is None or not any(has_periods_of(week_data, person_id)
+                                                                      for week_data in weeks)):
+            # the cached person id might be outdated (e.g. after the change of the school year),
+            # so the pageconfig is asked once - the weeks are only fetched again if the id changed
+            metadata.cache.forget(cache_key)
+            person_id = look_up_person_id()
+            logging.debug(f'{section_config["firstname"]}: no data for the cached person id {cached_person_id}, '
+                          f'the pageconfig has {person_id}')
+            if weeks is None or person_id != cached_person_id:
+                weeks = fetch_weeks()
+
+        timegrid = None
+        if "class" in section_config and any(has_result(week_data) for week_data in weeks):
+            rows = metadata.cache.get(cache_key, "timegrid_rows")
+            if rows is None:
+                rows, archived["timegrid"] = fetch_timegrid_rows(login)
+                metadata.cache.put(cache_key, "timegrid_rows", rows)
+            timegrid = {"data": {"rows": rows}}
+            if archived["timegrid"] is None:
+                # taken from the cache, so the rows are archived instead of the response
+                archived["timegrid"] = archive.store(json.dumps(timegrid).encode("utf-8"))
+    except Exception:
+        # the cached values might be the reason, so they are fetched again next time
+        metadata.cache.forget(cache_key)
+        raise
+    data = {"person_id": person_id,
+            "weeks": {week_start_date.isoformat(): week_data
+                      for week_start_date, week_data in zip(week_start_dates, weeks)},
+            "timegrid": timegrid}
+    if archive.directory is not None:
+        data["archived"] = archived
+    return data
+
+
+def has_result(week_data: dict) -> bool:
+    return "data" in week_data and "result" in week_data["data"]
+
+
+def has_periods_of(week_data: dict, person_id) -> bool:
+    return has_result(week_data) and str(person_id) in week_data["data"]["result"]["data"].get("elementPeriods", dict())
+
+
+def build_periods(section_config, days: list, person_id, week_data: dict, timegrid, infotexts_to_ignore,
+                  full_name) -> dict:
+    """
+    Collects the periods of one week as dict: start time -> date -> cell content.
+    """
+    periods_by_time = dict()
+
+    if timegrid is not None:
         for row in timegrid["data"]["rows"]:
-            start_time = datetime.time(hour=int(str(row["startTime"])[:-2]), minute=int(str(row["startTime"])[-2:]))
-            end_time = datetime.time(hour=int(str(row["endTime"])[:-2]), minute=int(str(row["endTime"])[-2:]))
+            start_time = parse_time(row["startTime"])
+            end_time = parse_time(row["endTime"])
             if (datetime.datetime.combine(datetime.date.today(), end_time)
                     - datetime.datetime.combine(datetime.date.today(), start_time) >= datetime.timedelta(minutes=45)
                     and len(periods_by_time) < 6):
@@ -157,295 +184,383 @@ def get_data_direct(section_config, week_start_date, target):
                         periods_by_time[start_time] = dict()
                     periods_by_time[start_time][day] = dict()
 
-    periods = week_data["data"]["result"]["data"]["elementPeriods"][str(person_id)]
-    elements = week_data["data"]["result"]["data"]["elements"]
-
-    infotexts_to_ignore = [t.strip() for t in section_config["ignore_infotext"].split(sep="|")] \
-        if "ignore_infotext" in section_config else ()
-
-    teacher_fullnames = eval(section_config["teacher_fullname_function"] + "()") \
-        if "teacher_fullname_function" in section_config else None
+    periods = parse_periods(week_data, person_id)
 
     for period in periods:
-        day = str(period["date"])
-        date = datetime.date(year=int(day[:4]), month=int(day[4:6]), day=int(day[6:]))
-        time = str(period["startTime"])
-        if time == '0':
-            start_time = datetime.time(hour=0, minute=0)
-        else:
-            start_time = datetime.time(hour=int(time[:-2]), minute=int(time[-2:]))
+        date = period.date
+        start_time = period.start_time
         if start_time not in periods_by_time:
             periods_by_time[start_time] = dict()
-        group_ids = get_element_id_list(period["elements"], 1)
-        teacher_ids = get_element_id_list(period["elements"], 2)
-        original_teacher_ids = get_element_id_list(period["elements"], 2, "orgId")
-        subject_ids = get_element_id_list(period["elements"], 3)
-        original_subject_ids = get_element_id_list(period["elements"], 3, "orgId")
-        room_ids = get_element_id_list(period["elements"], 4)
-        original_room_ids = get_element_id_list(period["elements"], 4, "orgId")
         if date not in periods_by_time[start_time]:
             periods_by_time[start_time][date] = dict()
+        cell = periods_by_time[start_time][date]
         kind = "yes"
-        if period["cellState"] == "EXAM":
-            periods_by_time[start_time][date]["cell_class"] = "exam"
-        elif period["cellState"] in ("SHIFT", "SUBSTITUTION", "ROOMSUBSTITUTION", "ADDITIONAL", "SUBST_TEXT"):
-            periods_by_time[start_time][date]["cell_class"] = "change"
-        elif period["cellState"] in ("CANCEL", "FREE"):
+        if period.cell_state == "EXAM":
+            cell["cell_class"] = "exam"
+        elif period.cell_state in ("SHIFT", "SUBSTITUTION", "ROOMSUBSTITUTION", "ADDITIONAL", "SUBST_TEXT"):
+            cell["cell_class"] = "change"
+        elif period.cell_state in ("CANCEL", "FREE"):
             kind = "no"
-            if "cell_class" not in periods_by_time[start_time][date]:
+            if "cell_class" not in cell:
                 # we don't already have another entry, so we may put "cancel" as cell class:
-                periods_by_time[start_time][date]["cell_class"] = "cancel"
-        elif period["cellState"] == "STANDARD":
+                cell["cell_class"] = "cancel"
+        elif period.cell_state == "STANDARD":
             # only if we don't have a cell class already (parallel entries: non-standard takes precendence)
-            if "cell_class" not in periods_by_time[start_time][date]:
-                periods_by_time[start_time][date]["cell_class"] = "normal"
+            if "cell_class" not in cell:
+                cell["cell_class"] = "normal"
         else:
-            periods_by_time[start_time][date]["cell_class"] = "warn"
-
-        if "teacher_as_cancelled" in section_config:
-            for teacher_id in teacher_ids:
-                if section_config["teacher_as_cancelled"] == get_element_name(elements, 2, teacher_id):
-                    periods_by_time[start_time][date]["cell_class"] = "cancel"
-        if "room_as_cancelled" in section_config:
-            for room_id in room_ids:
-                if section_config["room_as_cancelled"] == get_element_name(elements, 4, room_id):
-                    periods_by_time[start_time][date]["cell_class"] = "cancel"
-
-        for group_id in group_ids:
-            add_entry(periods_by_time[start_time][date], "group", kind, get_element_name(elements, 1, group_id))
-        for teacher_id in teacher_ids:
-            teacher = get_element_name(elements, 2, teacher_id)
-            if teacher_fullnames is not None and teacher in teacher_fullnames and teacher_fullnames[teacher]:
-                teacher = teacher_fullnames[teacher]
-            add_entry(periods_by_time[start_time][date], "teacher", kind, teacher)
-        for teacher_id in original_teacher_ids:
-            teacher = get_element_name(elements, 2, teacher_id)
-            if teacher_fullnames is not None and teacher in teacher_fullnames and teacher_fullnames[teacher]:
-                teacher = teacher_fullnames[teacher]
-            add_entry(periods_by_time[start_time][date], "teacher", "no", teacher)
-        for subject_id in subject_ids:
-            add_entry(periods_by_time[start_time][date], "subject", kind, get_element_name(elements, 3, subject_id))
-        for subject_id in original_subject_ids:
-            add_entry(periods_by_time[start_time][date], "subject", "no", get_element_name(elements, 3, subject_id))
-        for room_id in room_ids:
-            add_entry(periods_by_time[start_time][date], "room", kind, get_element_name(elements, 4, room_id))
-        for room_id in original_room_ids:
-            add_entry(periods_by_time[start_time][date], "room", "no", get_element_name(elements, 4, room_id))
-        end_time_str = str(period["endTime"])
-        end_time = datetime.time(hour=int(end_time_str[:-2]), minute=int(end_time_str[-2:]))
-        periods_by_time[start_time][date]["date"] = date
-        periods_by_time[start_time][date]["start_time"] = start_time
-        if ("end_time" not in periods_by_time[start_time][date]
-                or end_time > periods_by_time[start_time][date]["end_time"]):
-            periods_by_time[start_time][date]["end_time"] = end_time
-
-        if "infotext" not in periods_by_time[start_time][date]:
-            periods_by_time[start_time][date]["infotext"] = ""
-        if ("lessonText" in period and period["lessonText"] and
-                period["lessonText"] not in periods_by_time[start_time][date]["infotext"] and
-                period["lessonText"] not in infotexts_to_ignore):
-            if periods_by_time[start_time][date]["infotext"].strip() in period["lessonText"]:
-                periods_by_time[start_time][date]["infotext"] = f'{period["lessonText"]} '
-            else:
-                periods_by_time[start_time][date]["infotext"] += f'{period["lessonText"]} '
-        if ("periodText" in period and period["periodText"] and
-                period["periodText"] not in periods_by_time[start_time][date]["infotext"] and
-                period["periodText"] not in infotexts_to_ignore):
-            if periods_by_time[start_time][date]["infotext"].strip() in period["periodText"]:
-                periods_by_time[start_time][date]["infotext"] = f'{period["periodText"]} '
-            else:
-                periods_by_time[start_time][date]["infotext"] += f'{period["periodText"]} '
-        if ("periodInfo" in period and period["periodInfo"] and
-                period["periodInfo"] not in periods_by_time[start_time][date]["infotext"] and
-                period["periodInfo"] not in infotexts_to_ignore):
-            if periods_by_time[start_time][date]["infotext"].strip() in period["periodInfo"]:
-                periods_by_time[start_time][date]["infotext"] = f'{period["periodInfo"]} '
-            else:
-                periods_by_time[start_time][date]["infotext"] += f'{period["periodInfo"]} '
-        if ("substText" in period and period["substText"] and
-                period["substText"] not in periods_by_time[start_time][date]["infotext"] and
-                period["substText"] not in infotexts_to_ignore):
-            if periods_by_time[start_time][date]["infotext"].strip() in period["substText"]:
-                periods_by_time[start_time][date]["infotext"] = f'{period["substText"]} '
-            else:
-                periods_by_time[start_time][date]["infotext"] += f'{period["substText"]} '
-        if ("staffText" in period and period["staffText"] and
-                period["staffText"] not in periods_by_time[start_time][date]["infotext"] and
-                period["staffText"] not in infotexts_to_ignore):
-            if periods_by_time[start_time][date]["infotext"].strip() in period["staffText"]:
-                periods_by_time[start_time][date]["infotext"] = f'{period["staffText"]} '
-            else:
-                periods_by_time[start_time][date]["infotext"] += f'{period["staffText"]} '
-        if periods_by_time[start_time][date]["infotext"]:
+            cell["cell_class"] = "warn"
+
+        if "teacher_as_cancelled" in section_config and section_config["teacher_as_cancelled"] in period.teachers:
+            cell["cell_class"] = "cancel"
+        if "room_as_cancelled" in section_config and section_config["room_as_cancelled"] in period.rooms:
+            cell["cell_class"] = "cancel"
+
+        for group in period.groups:
+            add_entry(cell, "group", kind, group)
+        for teacher in period.teachers:
+            add_entry(cell, "teacher", kind, full_name(teacher))
+        for teacher in period.original_teachers:
+            add_entry(cell, "teacher", "no", full_name(teacher))
+        for subject in period.subjects:
+            add_entry(cell, "subject", kind, subject)
+        for subject in period.original_subjects:
+            add_entry(cell, "subject", "no", subject)
+        for room in period.rooms:
+            add_entry(cell, "room", kind, room)
+        for room in period.original_rooms:
+            add_entry(cell, "room", "no", room)
+        cell["date"] = date
+        cell["start_time"] = start_time
+        if "end_time" not in cell or period.end_time > cell["end_time"]:
+            cell["end_time"] = period.end_time
+
+        if "infotext" not in cell:
+            cell["infotext"] = ""
+        for text in period.texts:
+            if text not in cell["infotext"] and text not in infotexts_to_ignore:
+                if cell["infotext"].strip() in text:
+                    cell["infotext"] = f'{text} '
+                else:
+                    cell["infotext"] += f'{text} '
+        if cell["infotext"]:
             # delete duplicate words from infotext:
-            periods_by_time[start_time][date]["infotext"] \
-                = ' '.join(dict.fromkeys(periods_by_time[start_time][date]["infotext"].split()))
-
-    group_string = f' ({section_config["class"]})' if "class" in section_config else ''
-    write(target, f'''<h2>{section_config["firstname"]}{group_string}</h2>
-                       <table>
-                       <tr>
-                       <td class="width1"></td>''')
-    for date in days:
-        write(target,
-              f'<td class="width2 centered">{date.strftime("<b>%a</b> <span class=""smallbleak"">%d.%m.</span>")}</td>')
-    write(target, "</tr>")
-
-    for start_time in dict(sorted(periods_by_time.items())):
-        row = dict(sorted(periods_by_time[start_time].items()))
-        write(target, f'''<tr>
-                           <td class="height2 text_top">{start_time.strftime("%H:%M")} Uhr</td>''')
-        for date in days:
-            if date in row and row[date]:
-                period = row[date]
-                if "rowspan_applied" not in period or not period["rowspan_applied"]:
-                    row_span = 1
-                    start_time_to_check = start_time
-                    while get_next_key(periods_by_time, start_time_to_check):
-                        next_start_time = get_next_key(periods_by_time, start_time_to_check)
-                        if (next_start_time and next_start_time in periods_by_time and periods_by_time[next_start_time]
-                                and date in periods_by_time[next_start_time] and periods_by_time[next_start_time][date]
-                                and same_content(period, periods_by_time[next_start_time][date])
-                                or "end_time" in period and date in periods_by_time[next_start_time]
-                                and "start_time" in periods_by_time[next_start_time][date]
-                                and period["end_time"] > periods_by_time[next_start_time][date]["start_time"]):
-                            row_span = row_span + 1
-                            periods_by_time[next_start_time][date]["rowspan_applied"] = True
-                            # copy the values from the "rowspan master":
-                            copy_values_for(period, periods_by_time[next_start_time][date],
-                                            "teacher", "subject", "room", "group", "cell_class", "infotext")
-                        start_time_to_check = next_start_time
-                    if row_span > 1:
-                        row_span_str = f' rowspan="{row_span}"'
-                    else:
-                        row_span_str = ''
-                    if "class" in section_config:
-                        group_string = ""
-                        teacher_string = f'<span class="spaceleft">{period["teacher"]["yes"] if "yes" in period["teacher"] else ""}</span>' \
-                                         f'<span class="no{" spaceleft" if "yes" in period["teacher"] and "no" in period["teacher"] and ("yes" not in period["teacher"] or period["teacher"]["no"] != period["teacher"]["yes"]) else ""}">{period["teacher"]["no"] if "no" in period["teacher"] and ("yes" not in period["teacher"] or period["teacher"]["no"] != period["teacher"]["yes"]) else ""}</span>' \
-                                         if "teacher" in period else ""
-                    else:
-                        group_string = f'<span class="spaceright">{period["group"]["yes"] if "yes" in period["group"] else ""}</span>' \
-                                       f'<span class="no{" spaceleft" if "yes" in period["group"] and "no" in period["group"] else ""}">{period["group"]["no"] if "no" in period["group"] else ""}</span>'
-                        teacher_string = ""
-                    write(target,
-                          f'<td class="centered {period["cell_class"]}"{row_span_str}>{group_string}'
-                          f'{period["subject"]["yes"] if "subject" in period and "yes" in period["subject"] else ""}'
-                          f'<span class="no{" spaceleft" if "subject" in period and "yes" in period["subject"] and "no" in period["subject"] else ""}">{period["subject"]["no"] if "subject" in period and "no" in period["subject"] else ""}</span>'
-                          f'{teacher_string}<br/>'
-                          f'<small>@ {period["room"]["yes"] if "room" in period and "yes" in period["room"] else ""}'
-                          f'<span class="no{" spaceleft" if "room" in period and "yes" in period["room"] and "no" in period["room"] and period["room"]["no"] != period["room"]["yes"] else ""}">{period["room"]["no"] if "room" in period and "no" in period["room"] and ("yes" not in period["room"] or period["room"]["no"] != period["room"]["yes"]) else ""}</span></small>'
-                          f'{"<br/>" + period["infotext"].strip() if "infotext" in period and len(period["infotext"]) else ""}</td>')
-                if statistics:
-                    planned_teacher = None
-                    actual_teacher = None
-                    planned_subject = None
-                    actual_subject = None
-                    if "teacher" in periods_by_time[start_time][date]:
-                        if "no" in periods_by_time[start_time][date]["teacher"]:
-                            planned_teacher = periods_by_time[start_time][date]["teacher"]["no"]
-                        else:
-                            planned_teacher = periods_by_time[start_time][date]["teacher"]["yes"]
-                        if "yes" in periods_by_time[start_time][date]["teacher"]:
-                            actual_teacher = periods_by_time[start_time][date]["teacher"]["yes"]
-                    if "subject" in periods_by_time[start_time][date]:
-                        if "no" in periods_by_time[start_time][date]["subject"]:
-                            planned_subject = periods_by_time[start_time][date]["subject"]["no"]
-                        else:
-                            planned_subject = periods_by_time[start_time][date]["subject"]["yes"]
-                        if "yes" in periods_by_time[start_time][date]["subject"]:
-                            actual_subject = periods_by_time[start_time][date]["subject"]["yes"]
-                    if "cell_class" in periods_by_time[start_time][date]:
-                        is_cancelled = periods_by_time[start_time][date]["cell_class"] == "cancel"
-                    else:
-                        is_cancelled = False
-                    if "infotext" in periods_by_time[start_time][date]:
-                        comment = periods_by_time[start_time][date]["infotext"]
-                    else:
-                        comment = None
-                    statistics.put(datetime.datetime.combine(date, start_time),
-                                   planned_teacher,
-                                   planned_subject,
-                                   actual_teacher=actual_teacher,
-                                   actual_subject=actual_subject,
-                                   is_cancelled=is_cancelled,
-                                   comment=comment)
-            else:
-                write(target, "<td></td>")
-        write(target, "</tr>")
-    write(target, "</table>")
-    if statistics:
-        statistics.save()
-        write(target, f'<span class="bleak">seit {statistics.earliest_date().strftime("%d.%m.%Y")}:'
-                      f' Entfall = {round(100 * statistics.percentage_cancelled(), 1)} % /'
-                      f' Fach&auml;nderung = {round(100 * statistics.percentage_changed_subject(), 1)} % /'
-                      f' personelle &Auml;nderung = {round(100 * statistics.percentage_changed_teacher(), 1)} %</span>')
+            cell["infotext"] = ' '.join(dict.fromkeys(cell["infotext"].split()))
+    return periods_by_time
 
 
-def copy_values_for(source_dict: dict, target_dict: dict, *keys: str):
-    for key in keys:
-        if key in source_dict:
-            target_dict[key] = source_dict[key]
+def write_table(section_config, days: list, rows: list, target):
+    target.write(render.table(section_config, days, rows))
 
 
-def same_content(one: dict, two: dict):
-    return (one.get("cell_class") == two.get("cell_class")
-            and one.get("teacher") == two.get("teacher")
-            and one.get("group") == two.get("group")
-            and one.get("subject") == two.get("subject")
-            and one.get("room") == two.get("room"))
+def write_data(section_config, data: dict, shown_week_start_dates: list, target):
+    """
+    Writes the timetables of the shown weeks as HTML tables and records the statistics
+    of all fetched weeks up to the first shown one if configured (later weeks still can change).
+    """
+    person_id = data["person_id"]
+    timegrid = data["timegrid"]
 
+    statistics = None
+    if "statistics_file" in section_config:
+        # the statistics (and openpyxl) are only imported when configured
+        from webuntis_fetcher.statistics import create_statistics, export_due, is_sqlite_file
+        statistics = create_statistics(section_config["statistics_file"], statistics_title(section_config))
+        statistics.open()
+        if (is_sqlite_file(section_config["statistics_file"]) and statistics.count_all == 0
+                and "statistics_export_file" in section_config
+                and os.path.isfile(section_config["statistics_export_file"])):
+            # switching from XLSX to SQLite: keep the history
+            statistics.import_from(section_config["statistics_export_file"])
 
-def open_if_necessary(name, mode=None):
-    if isinstance(name, TextIO) or isinstance(name, TextIOWrapper):
-        return name
+    infotexts_to_ignore = [t.strip() for t in section_config["ignore_infotext"].split(sep="|")] \
+        if "ignore_infotext" in section_config else ()
+
+    teacher_fullnames = teachers.full_names(section_config["teacher_fullname_function"]) \
+        if "teacher_fullname_function" in section_config else None
+
+    def full_name(teacher: str) -> str:
+        if teacher_fullnames is not None and teacher in teacher_fullnames and teacher_fullnames[teacher]:
+            return teacher_fullnames[teacher]
+        return teacher
+
+    heading_written = False
+    any_result = False
+    for week_start_date_string, week_data in sorted(data["weeks"].items()):
+        if not has_result(week_data):
+            continue
+        any_result = True
+        week_start_date = datetime.date.fromisoformat(week_start_date_string)
+        days = [week_start_date + datetime.timedelta(days=x) for x in range(5)]
+        periods_by_time = build_periods(section_config, days, person_id, week_data, timegrid,
+                                        infotexts_to_ignore, full_name)
+        rows = layout(periods_by_time, days)
+        if week_start_date in shown_week_start_dates:
+            if not heading_written:
+                target.write(render.heading(section_config))
+                heading_written = True
+            write_table(section_config, days, rows, target)
+        if statistics and week_start_date <= shown_week_start_dates[0]:
+            for start_time, cells in rows:
+                for date, cell in zip(days, cells):
+                    if cell is not None:
+                        put_statistics(statistics, datetime.datetime.combine(date, start_time),
+                                       periods_by_time[start_time][date])
+    if statistics and any_result:
+        statistics.save()
+        if (is_sqlite_file(section_config["statistics_file"]) and "statistics_export_file" in section_config
+                and export_due(section_config["statistics_export_file"],
+                               section_config.getfloat("statistics_export_hours", fallback=24))):
+            statistics.export(section_config["statistics_export_file"])
+        target.write(render.statistics_line(statistics))
+    if statistics:
+        statistics.close()
+
+
+def statistics_title(section_config) -> str:
+    return f'{section_config["firstname"]} {section_config["lastname"]} - {section_config["class"]}'
+
+
+def put_statistics(statistics, timestamp: datetime.datetime, period: dict):
+    planned_teacher = None
+    actual_teacher = None
+    planned_subject = None
+    actual_subject = None
+    if "teacher" in period:
+        if "no" in period["teacher"]:
+            planned_teacher = period["teacher"]["no"]
+        else:
+            planned_teacher = period["teacher"]["yes"]
+        if "yes" in period["teacher"]:
+            actual_teacher = period["teacher"]["yes"]
+    if "subject" in period:
+        if "no" in period["subject"]:
+            planned_subject = period["subject"]["no"]
+        else:
+            planned_subject = period["subject"]["yes"]
+        if "yes" in period["subject"]:
+            actual_subject = period["subject"]["yes"]
+    if "cell_class" in period:
+        is_cancelled = period["cell_class"] == "cancel"
+    else:
+        is_cancelled = False
+    if "infotext" in period:
+        comment = period["infotext"]
     else:
-        return open(name, mode=mode)
+        comment = None
+    statistics.put(timestamp,
+                   planned_teacher,
+                   planned_subject,
+                   actual_teacher=actual_teacher,
+                   actual_subject=actual_subject,
+                   is_cancelled=is_cancelled,
+                   comment=comment)
 
 
-def run(config):
+def export_statistics(config):
+    """
+    Exports the statistics of all sections which keep them in SQLite to their statistics_export_file.
+    """
+    from webuntis_fetcher.statistics import create_statistics, is_sqlite_file
+    for section in config:
+        if (section not in ('DEFAULT', 'OUTPUT') and "statistics_file" in config[section]
+                and is_sqlite_file(config[section]["statistics_file"])
+                and "statistics_export_file" in config[section]):
+            statistics = create_statistics(config[section]["statistics_file"], statistics_title(config[section]))
+            statistics.open()
+            statistics.export(config[section]["statistics_export_file"])
+            statistics.close()
+            logging.debug(f'{section}: exported statistics to {config[section]["statistics_export_file"]}')
+
+
+def get_data_direct(section_config, week_start_date, target):
+    write_data(section_config, fetch_data(section_config, [week_start_date]), [week_start_date], target)
+
+
+def fetch_section(section: str, section_config, week_start_dates: list, workers: int):
+    """
+    Fetches the data of one section so sections can be handled in parallel.
+    Returns the data (None if it could not be fetched) and the exit code (0 if everything went fine).
+    """
+    try:
+        with phase("fetch", section):
+            data = fetch_data(section_config, week_start_dates, workers)
+        archive.record(section, data)
+        return data, 0
+    except FetchError as fe:
+        logging.log(logging.ERROR, f"{section}: {fe}")
+        return None, fe.exit_code
+    except requests.RequestException as e:
+        # connection problems only affect this section
+        logging.log(logging.WARNING, f"{section}: {e}")
+        return None, 1
+    except Exception as e:
+        # e.g. a response with an unexpected structure
+        logging.exception(f"{section}: could not fetch the timetable: {e}")
+        return None, 1
+
+
+def render_section(section: str, section_config, data: dict, shown_week_start_dates: list):
+    """
+    Returns the HTML of the section, or None if it could not be rendered - the other sections are still written.
+    """
+    buffer = StringIO()
+    if data is not None:
+        try:
+            with phase("render", section):
+                write_data(section_config, data, shown_week_start_dates, buffer)
+        except Exception as e:
+            logging.exception(f"{section}: could not render the timetable: {e}")
+            return None
+    return buffer.getvalue()
+
+
+def refresh_timestamp(filename: str):
+    """
+    Only updates the "Stand" line of an existing timetable file.
+    """
+    with open(filename) as timetable_file:
+        html = timetable_file.read()
+    replace_file(filename, re.sub(r'<span class="smallbold">Stand: [^<]*</span><br/>',
+                                         lambda match: render.timestamp_line(), html, count=1))
+
+
+def output_of(config):
     if "OUTPUT" in config and "timetable_file" in config["OUTPUT"]:
-        outfile = config["OUTPUT"]["timetable_file"]
-    else:
-        outfile = sys.stdout
-    logging.debug(f'starting run - output to {outfile}')
-
-    with open_if_necessary(outfile, "w") as target_file:
-        write(target_file, '''<html>
-                           <head>
-                           <title>Stundenplan</title>
-                           <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
-                           <style>
-                           .width1 { width: 120px }
-                           .width2 { width: 150px }
-                           .height2 { height: 47px }
-                           .text_top { vertical-align: top }
-                           .centered { text-align: center; vertical-align: middle }
-                           .smallbleak { color: #999999; font-size: small }
-                           .bleak { color: #999999 }
-                           .smallbold { font-size: small; font-weight: bold }
-                           .no { text-decoration: line-through }
-                           .spaceleft { padding-left: 0.5em }
-                           .spaceright { padding-right: 0.5em }
-                           .normal { background-color: rgba(245, 160, 35, 0.7) }
-                           .exam { background-color: rgba(255, 235, 0, 0.7) }
-                           .change { background-color: rgba(200, 160, 210) }
-                           .cancel { background-color: rgba(195, 195, 195) }
-                           .warn { background-color: rgba(255, 50, 50) }
-                           </style>
-                           </head>
-                           <body>'''
-                           f'<span class="smallbold">Stand: {datetime.datetime.now().strftime("%H:%M Uhr, %d.%m.%Y")}</span><br/>')
-        for section in config:
-            if section not in ('DEFAULT', 'OUTPUT'):
-                today = datetime.date.today()
-                target = today + datetime.timedelta(days=2)
-                monday = target - datetime.timedelta(days=target.weekday())
-                try:
-                    get_data_direct(config[section], monday, target_file)
-                except requests.RequestException as re:
-                    # silently ignore connection problems
-                    exit(1)
-
-        write(target_file, '''</body>
-                                </html>''')
+        return config["OUTPUT"]["timetable_file"]
+    return sys.stdout
+
+
+def shown_week_start_dates(config) -> list:
+    """
+    Returns the Mondays of the displayed weeks: the week of the day after tomorrow and weeks_ahead more.
+    """
+    target = datetime.date.today() + datetime.timedelta(days=2)
+    monday = target - datetime.timedelta(days=target.weekday())
+    return [monday + datetime.timedelta(weeks=x)
+            for x in range(config.getint("OUTPUT", "weeks_ahead", fallback=0) + 1)]
+
+
+def write_page(outfile, results: list):
+    # the whole page is rendered first, so the file is replaced at once and never seen half-written
+    with phase("write"):
+        html = render.page(results)
+        if outfile is sys.stdout:
+            outfile.write(html)
+        else:
+            replace_file(outfile, html)
+
+
+def run(config):
+    outfile = output_of(config)
+    workers = config.getint("OUTPUT", "workers", fallback=4)
+    teachers.configure(config)
+    metadata.configure(config)
+    snapshots.configure(config)
+    archive.configure(config)
+    logging.debug(f'starting run - output to {outfile} using {workers} worker(s)')
+
+    shown_weeks = shown_week_start_dates(config)
+    monday = shown_weeks[0]
+    # past weeks are only fetched for the statistics:
+    statistics_weeks = [monday - datetime.timedelta(weeks=x)
+                        for x in range(config.getint("OUTPUT", "weeks_back", fallback=0), 0, -1)]
+
+    def weeks_of(section: str) -> list:
+        return statistics_weeks + shown_weeks if "statistics_file" in config[section] else shown_weeks
+
+    sections = [section for section in config if section not in ('DEFAULT', 'OUTPUT')]
+    state_file = config.get("OUTPUT", "state_file", fallback=None)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # map() keeps the config order of the sections
+        fetched = list(executor.map(lambda section: fetch_section(section, config[section], weeks_of(section),
+                                                                  workers),
+                                    sections))
+        exit_codes = [exit_code for _, exit_code in fetched if exit_code]
+        metadata.cache.save()
+
+        fingerprints = {section: fingerprint(config[section], data)
+                        for section, (data, _) in zip(sections, fetched) if data is not None}
+        if (state_file and not exit_codes and outfile is not sys.stdout and os.path.isfile(outfile)
+                and fingerprints == load_fingerprints(state_file)):
+            logging.debug("nothing changed, only updating the timestamp")
+            refresh_timestamp(outfile)
+            return
+
+        results = list(executor.map(lambda section, fetched_section: render_section(section, config[section],
+                                                                                    fetched_section[0],
+                                                                                    shown_weeks),
+                                    sections, fetched))
+
+    # sections which couldn't be fetched (e.g. because of a timeout) or rendered show their last state
+    for index, (section, (data, _)) in enumerate(zip(sections, fetched)):
+        if data is not None and results[index] is not None:
+            snapshots.store.put(section, results[index])
+            continue
+        if results[index] is None:
+            exit_codes.append(1)
+            fingerprints.pop(section, None)
+        results[index] = ""
+        snapshot = snapshots.store.get(section)
+        if snapshot is not None:
+            logging.log(logging.WARNING, f"{section}: showing the last successfully fetched data")
+            results[index] = render.stale(snapshot["html"], snapshot["stored"])
+    snapshots.store.save()
+
+    write_page(outfile, results)
+
+    if state_file:
+        save_fingerprints(state_file, fingerprints)
+    if exit_codes:
+        exit(exit_codes[0])
+
+
+def archived_data(section: str):
+    """
+    Puts the archived responses of a section together like fetch_data() does, None if there are none.
+    """
+    entries = archive.weeks_of(section)
+    if not entries:
+        return None
+    latest = entries[max(entries)]
+    timegrid_digest = next((entry["timegrid"] for _, entry in sorted(entries.items(), reverse=True)
+                            if entry["timegrid"]), None)
+    return {"person_id": latest["person_id"],
+            "weeks": {week_start_date: archive.load(entry["weekly_data"])
+                      for week_start_date, entry in entries.items()},
+            "timegrid": {"data": {"rows": timegrid_rows(archive.load(timegrid_digest))}}
+            if timegrid_digest is not None else None}
+
+
+def replay(config):
+    """
+    Renders the timetable and records the statistics from the responses in archive_dir without any
+    network access, e.g. after changing layout options or to rebuild the statistics. All archived weeks
+    up to the first displayed one go into the statistics. The weeks a normal run would display are
+    shown, or the last archived week if they are not in the archive.
+    """
+    archive.configure(config)
+    if archive.directory is None:
+        logging.log(logging.ERROR, "the replay mode needs archive_dir in [OUTPUT]")
+        exit(2)
+    teachers.configure(config)
+    teachers.offline = True
+    outfile = output_of(config)
+    shown_weeks = shown_week_start_dates(config)
+
+    results = list()
+    for section in config:
+        if section in ('DEFAULT', 'OUTPUT'):
+            continue
+        with phase("archive_load", section):
+            data = archived_data(section)
+        if data is None:
+            logging.log(logging.WARNING, f"{section}: nothing archived in {archive.directory}")
+            results.append("")
+            continue
+        shown = [week_start_date for week_start_date in shown_weeks if week_start_date.isoformat() in data["weeks"]]
+        if not shown:
+            shown = [datetime.date.fromisoformat(max(data["weeks"]))]
+        logging.debug(f'{section}: replaying {len(data["weeks"])} archived week(s)')
+        results.append(render_section(section, config[section], data, shown) or "")
+    write_page(outfile, results)
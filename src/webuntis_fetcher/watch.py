@@ -0,0 +1,162 @@
+import configparser
+import logging
+import os
+import random
+import time
+
+from webuntis_fetcher import metrics, session, teachers
+
+# how often the config file is checked for changes (in seconds)
+RELOAD_CHECK_INTERVAL = 10
+
+
+class Job:
+    """
+    A regularly executed run of the timetable or messages mode. After a failure, the interval
+    is doubled up to max_backoff_seconds, after a successful run it is reset.
+    """
+
+    def __init__(self, name: str, interval_seconds: float, jitter_seconds: float, max_backoff_seconds: float):
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.jitter_seconds = jitter_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.failures = 0
+        self.next_run = time.time()
+
+    def schedule(self, successful: bool):
+        if successful:
+            self.failures = 0
+            delay = self.interval_seconds
+        else:
+            self.failures += 1
+            delay = min(self.interval_seconds * 2 ** self.failures,
+                        max(self.interval_seconds, self.max_backoff_seconds))
+            logging.log(logging.WARNING, f"{self.name} failed {self.failures} time(s), next try in {delay:.0f} s")
+        # the jitter spreads the requests of multiple jobs (and installations) over time
+        self.next_run = time.time() + delay + random.uniform(0, self.jitter_seconds)
+
+
+def selected(config: configparser.ConfigParser, sections: list) -> configparser.ConfigParser:
+    """
+    Returns a copy of the config which only contains the OUTPUT section and the given sections.
+    """
+    result = configparser.ConfigParser()
+    result.read_dict({section: dict(config.items(section, raw=True))
+                      for section in ["OUTPUT"] + sections if config.has_section(section)})
+    return result
+
+
+def read_config(config_file: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    with open(config_file) as file:
+        config.read_file(file)
+    return config
+
+
+def create_jobs(config: configparser.ConfigParser, old_jobs: dict) -> dict:
+    """
+    Creates a job for the timetable (if timetable_file is configured) and one for the messages of
+    each section with a message_id_file. Jobs which existed before keep their schedule.
+    """
+    def job(name: str, interval_minutes: float) -> Job:
+        new_job = Job(name, 60 * interval_minutes, config.getfloat("OUTPUT", "jitter_seconds", fallback=30),
+                      60 * config.getfloat("OUTPUT", "max_backoff_minutes", fallback=60))
+        if name in old_jobs:
+            new_job.failures = old_jobs[name].failures
+            new_job.next_run = min(old_jobs[name].next_run, time.time() + new_job.interval_seconds)
+        return new_job
+
+    jobs = dict()
+    if config.has_option("OUTPUT", "timetable_file"):
+        jobs["timetable"] = job("timetable", config.getfloat("OUTPUT", "timetable_interval", fallback=15))
+    else:
+        logging.log(logging.INFO, "no timetable_file configured, only fetching messages")
+    for section in config:
+        if section not in ('DEFAULT', 'OUTPUT') and "message_id_file" in config[section]:
+            jobs[f"messages {section}"] = job(f"messages {section}",
+                                             config[section].getfloat("messages_interval",
+                                                                      fallback=config.getfloat(
+                                                                          "OUTPUT", "messages_interval",
+                                                                          fallback=15)))
+    return jobs
+
+
+def run_jobs(config: configparser.ConfigParser, due: list):
+    """
+    Runs the due jobs: the timetable for all sections with firstname and lastname, the messages of all
+    due sections in one run so they share the pipeline.
+    """
+    results = dict()
+    if "timetable" in due:
+        sections = [section for section in config if section not in ('DEFAULT', 'OUTPUT')
+                    and "lastname" in config[section]]
+        try:
+            # imported here so a watch which only fetches messages doesn't load the timetable modules
+            from webuntis_fetcher import timetable
+            metrics.start("timetable")
+            session.start_deadline(config)
+            timetable.run(selected(config, sections))
+            results["timetable"] = True
+        except SystemExit as e:
+            results["timetable"] = not e.code
+        except Exception as e:
+            logging.exception(f"timetable: {e}")
+            results["timetable"] = False
+        metrics.report(config)
+    message_sections = [name[len("messages "):] for name in due if name.startswith("messages ")]
+    if message_sections:
+        try:
+            from webuntis_fetcher import messages
+            metrics.start("messages")
+            session.start_deadline(config)
+            successful = messages.run(selected(config, message_sections))
+        except SystemExit as e:
+            successful = not e.code
+        except Exception as e:
+            logging.exception(f"messages: {e}")
+            successful = False
+        metrics.report(config)
+        for section in message_sections:
+            results[f"messages {section}"] = successful
+    return results
+
+
+def run(config_file: str):
+    """
+    Runs the timetable and messages modes periodically without ending. The sessions and logins
+    are kept between the runs, and changes to the config file are applied without restarting.
+    """
+    config = read_config(config_file)
+    config_mtime = os.path.getmtime(config_file)
+    session.configure(config)
+    jobs = create_jobs(config, dict())
+    if not jobs:
+        logging.log(logging.ERROR, f"nothing to do - configure timetable_file or message_id_file in {config_file}")
+        exit(2)
+    logging.log(logging.INFO, f"watching with {len(jobs)} job(s)")
+    # the timetable doesn't wait for the teacher names, outdated ones are refreshed in the background
+    teachers.refresh_in_background = True
+
+    while True:
+        now = time.time()
+        due = [name for name, job in jobs.items() if job.next_run <= now]
+        if due:
+            for name, successful in run_jobs(config, due).items():
+                jobs[name].schedule(successful)
+
+        try:
+            if os.path.getmtime(config_file) != config_mtime:
+                config_mtime = os.path.getmtime(config_file)
+                new_config = read_config(config_file)
+                # logins might have changed, so they are done again (or taken from the auth cache)
+                session.close_all()
+                session.configure(new_config)
+                config = new_config
+                jobs = create_jobs(config, jobs)
+                logging.log(logging.INFO, f"reloaded {config_file}, now watching with {len(jobs)} job(s)")
+        except (OSError, configparser.Error) as e:
+            logging.log(logging.ERROR, f"could not reload {config_file}, keeping the previous config: {e}")
+
+        next_run = min((job.next_run for job in jobs.values()), default=time.time() + RELOAD_CHECK_INTERVAL)
+        time.sleep(max(0.0, min(next_run - time.time(), RELOAD_CHECK_INTERVAL)))
@@ -0,0 +1,148 @@
+# offline benchmark of parsing, layout, HTML generation and saving the statistics with synthetic data
+# usage: python3 util/benchmark.py [--profile NAME ...] [--weeks N] [--min-time SECONDS] [--json FILE]
+
+import argparse
+import configparser
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import openpyxl  # noqa: E402,F401 - imported here so the lazy import of the statistics isn't measured
+import synthetic  # noqa: E402
+from webuntis_fetcher.layout import layout  # noqa: E402
+from webuntis_fetcher.periods import parse_periods  # noqa: E402
+from webuntis_fetcher.statistics import SqliteStatistics, Statistics  # noqa: E402
+from webuntis_fetcher.timetable import build_periods, put_statistics, write_data, write_table  # noqa: E402
+
+
+def section_config(profile: synthetic.Profile):
+    config = configparser.ConfigParser()
+    config["Benchmark"] = {"firstname": "Bench", "lastname": "Mark", "teacher_as_cancelled": "T1",
+                           "ignore_infotext": "Vertretung"}
+    if profile.student:
+        config["Benchmark"]["class"] = "5a"
+    return config["Benchmark"]
+
+
+def measure(function, items: list, min_time: float, setup=None, teardown=None, scale: int = 1) -> dict:
+    """
+    Calls the function for all items (converted by setup if given, which is not measured) until min_time
+    has passed, but at least once. Then each call is repeated with tracemalloc to get the peak memory
+    of the function. Returns the items (multiplied by scale) per second and the peak memory.
+    """
+    calls = 0
+    elapsed = 0.0
+    while elapsed < min_time or calls == 0:
+        for item in items:
+            argument = setup(item) if setup is not None else item
+            begin = time.perf_counter()
+            function(argument)
+            elapsed += time.perf_counter() - begin
+            calls += 1
+            if teardown is not None:
+                teardown(argument)
+    peak = 0
+    tracemalloc.start()
+    for item in items:
+        argument = setup(item) if setup is not None else item
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function(argument)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        if teardown is not None:
+            teardown(argument)
+    tracemalloc.stop()
+    return {"per_second": round(calls * scale / elapsed, 1), "peak_kb": round(peak / 1024, 1)}
+
+
+def benchmark(profile: synthetic.Profile, weeks: int, min_time: float) -> dict:
+    config = section_config(profile)
+    monday = datetime.date(2025, 9, 1)
+    week_start_dates = [monday + datetime.timedelta(weeks=x) for x in range(weeks)]
+    weeks_with_data = [(week_start_date, synthetic.week_data(profile, week_start_date))
+                       for week_start_date in week_start_dates]
+    timegrid = synthetic.timegrid(profile.slots) if profile.student else None
+
+    def days_of(week_start_date: datetime.date) -> list:
+        return [week_start_date + datetime.timedelta(days=x) for x in range(5)]
+
+    def periods_of(week: tuple) -> dict:
+        week_start_date, week_data = week
+        return build_periods(config, days_of(week_start_date), synthetic.PERSON_ID, week_data, timegrid, (),
+                             lambda teacher: teacher)
+
+    def laid_out(week: tuple) -> tuple:
+        periods_by_time = periods_of(week)
+        return week[0], periods_by_time, layout(periods_by_time, days_of(week[0]))
+
+    results = {"periods_per_week": round(sum(len(parse_periods(week_data, synthetic.PERSON_ID))
+                                             for _, week_data in weeks_with_data) / weeks, 1)}
+    results["parse"] = measure(lambda week: parse_periods(week[1], synthetic.PERSON_ID), weeks_with_data, min_time)
+    results["build_periods"] = measure(periods_of, weeks_with_data, min_time)
+    # layout changes the periods it merges, so each call gets fresh ones
+    results["layout"] = measure(lambda week: layout(week[1], days_of(week[0])), weeks_with_data, min_time,
+                                setup=lambda week: (week[0], periods_of(week)))
+    tables = [laid_out(week) for week in weeks_with_data]
+    results["html"] = measure(lambda table: write_table(config, days_of(table[0]), table[2], StringIO()),
+                              tables, min_time)
+    data = {"person_id": synthetic.PERSON_ID, "timegrid": timegrid,
+            "weeks": {week_start_date.isoformat(): week_data for week_start_date, week_data in weeks_with_data}}
+    results["write_data"] = measure(lambda shown: write_data(config, data, [shown], StringIO()),
+                                    [week_start_dates[0]], min_time)
+
+    lessons = sum(1 for _, _, rows in tables for _, cells in rows for cell in cells if cell is not None)
+    with tempfile.TemporaryDirectory() as directory:
+        for backend, extension in ((Statistics, "xlsx"), (SqliteStatistics, "db")):
+            def filled(number: int):
+                statistics = backend(os.path.join(directory, f"{number}.{extension}"), "Bench Mark - 5a")
+                statistics.open()
+                for week in weeks_with_data:
+                    week_start_date, periods_by_time, rows = laid_out(week)
+                    for start_time, cells in rows:
+                        for date, cell in zip(days_of(week_start_date), cells):
+                            if cell is not None:
+                                put_statistics(statistics, datetime.datetime.combine(date, start_time),
+                                               periods_by_time[start_time][date])
+                return statistics
+
+            numbers = iter(range(1000000))
+            results[f"save_{extension}"] = measure(lambda statistics: statistics.save(), [None], min_time,
+                                                   setup=lambda _: filled(next(numbers)),
+                                                   teardown=lambda statistics: statistics.close(),
+                                                   scale=lessons)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmark with synthetic WebUntis data")
+    parser.add_argument("--profile", action="append", choices=sorted(synthetic.PROFILES),
+                        help="profile to run (can be given multiple times), default: all")
+    parser.add_argument("--weeks", type=int, default=4, help="number of weeks per profile")
+    parser.add_argument("--min-time", type=float, default=0.5, help="minimum seconds per measurement")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    units = {"parse": "weeks/s", "build_periods": "weeks/s", "layout": "weeks/s", "html": "weeks/s",
+             "write_data": "runs/s", "save_xlsx": "lessons/s", "save_db": "lessons/s"}
+    results = dict()
+    for name in args.profile or synthetic.PROFILES:
+        results[name] = benchmark(synthetic.PROFILES[name], args.weeks, args.min_time)
+        print(f'{name} ({results[name]["periods_per_week"]} periods per week)')
+        for phase, unit in units.items():
+            print(f'  {phase:14} {results[name][phase]["per_second"]:12.1f} {unit:10}'
+                  f' peak {results[name][phase]["peak_kb"]:10.1f} KB')
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# this script measures the startup (import) time of each mode using "python -X importtime"
+# usage: python3 util/importtime.py [--runs N] [--top N] [--json FILE]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODES = ("timetable", "messages", "export-statistics", "watch", "replay")
+# modules which are expensive to import and should only be loaded by the modes which need them
+HEAVY_MODULES = ("bs4", "openpyxl", "sqlite3", "smtplib")
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+
+def measure(mode: str) -> dict:
+    """
+    Imports everything the mode needs in a fresh interpreter and returns the total time
+    (in microseconds) and the cumulative time of each imported module.
+    """
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [SOURCE_DIR, environment.get("PYTHONPATH")]))
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                              f"from webuntis_fetcher import starter; starter.load_mode({mode!r})"],
+                             env=environment, capture_output=True, text=True, check=True)
+    modules = dict()
+    total = 0
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative_time, name = line[len("import time:"):].split("|")
+        total += int(self_time)
+        modules[name.strip()] = int(cumulative_time)
+    return {"total": total, "modules": modules}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure the import time of each mode")
+    parser.add_argument("--runs", type=int, default=5, help="runs per mode, the median is reported")
+    parser.add_argument("--top", type=int, default=5, help="number of slowest modules to show per mode")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = dict()
+    for mode in MODES:
+        runs = [measure(mode) for _ in range(args.runs)]
+        modules = runs[-1]["modules"]
+        results[mode] = {"median_ms": round(statistics.median(run["total"] for run in runs) / 1000, 1),
+                         "heavy_modules": [module for module in HEAVY_MODULES if module in modules],
+                         "slowest": sorted(((name, round(time / 1000, 1)) for name, time in modules.items()
+                                            if "." not in name),
+                                           key=lambda entry: entry[1], reverse=True)[:args.top]}
+        print(f'{mode:18} {results[mode]["median_ms"]:8.1f} ms'
+              f'   heavy: {", ".join(results[mode]["heavy_modules"]) or "-"}')
+        for name, time in results[mode]["slowest"]:
+            print(f'{"":18} {time:8.1f} ms   {name}')
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# end-to-end load test: runs the timetable and/or messages mode against the local mock server with many sections
+# usage: python3 util/loadtest.py [--sections 200] [--users 20] [--mode both] [--workers 4] [--latency MS]
+#        [--requests-per-minute N] [--throttle-rate FRACTION] ...
+
+import argparse
+import configparser
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import mock_server  # noqa: E402
+from webuntis_fetcher import mail, metrics, session  # noqa: E402
+
+
+def create_config(directory: str, server_port: int, smtp_port: int, args) -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config["OUTPUT"] = {"timetable_file": os.path.join(directory, "timetable.html"),
+                        "workers": str(args.workers),
+                        "weeks_ahead": str(args.weeks_ahead),
+                        "requests_per_minute": str(args.requests_per_minute),
+                        "concurrent_requests": str(args.concurrent_requests)}
+    for number in range(1, args.sections + 1):
+        section = {"server": f"http://127.0.0.1:{server_port}",
+                   "school": "mock",
+                   # several sections share a login, like parents with multiple children
+                   "username": f"user{number % args.users}",
+                   "password": "secret",
+                   "firstname": f"Child{number}",
+                   "lastname": "Test",
+                   "message_id_file": os.path.join(directory, f"message-ids-{number % args.users}.csv"),
+                   "mail_from": "webuntis@localhost",
+                   "mail_to": f"parent{number % args.users}@localhost",
+                   "mail_host": f"127.0.0.1:{smtp_port}"}
+        if number % 2:
+            section["class"] = "5a"
+            # the statistics are only kept in student mode
+            if args.statistics:
+                section["statistics_file"] = os.path.join(directory, f"statistics-{number}.{args.statistics}")
+        config[f"Section {number}"] = section
+    return config
+
+
+def run_mode(name: str, function, config) -> dict:
+    session.close_all()
+    session.configure(config)
+    metrics.start(name)
+    begin = time.perf_counter()
+    try:
+        # messages prints each unread message
+        with contextlib.redirect_stdout(io.StringIO()):
+            function(config)
+    except SystemExit as e:
+        print(f"  {name} exited with code {e.code}")
+    elapsed = time.perf_counter() - begin
+    return {"seconds": elapsed, "metrics": metrics.summary()}
+
+
+def print_result(name: str, result: dict, sections: int, requests: int, extra: str = ""):
+    print(f'{name}: {result["seconds"]:.2f} s, {sections / result["seconds"]:.1f} sections/s, '
+          f'{requests} requests ({requests / result["seconds"]:.1f}/s){extra}')
+    phases = dict()
+    for section_metrics in result["metrics"]["sections"].values():
+        for phase, values in section_metrics["phases"].items():
+            total = phases.setdefault(phase, {"count": 0, "seconds": 0.0, "errors": 0})
+            for key in total:
+                total[key] += values[key]
+    for phase, values in sorted(phases.items(), key=lambda entry: entry[1]["seconds"], reverse=True):
+        print(f'  {phase:18} {values["count"]:7} x  {values["seconds"]:9.2f} s total'
+              f'  {1000 * values["seconds"] / values["count"]:8.1f} ms avg  {values["errors"]:5} errors')
+    for host, values in result["metrics"]["hosts"].items():
+        print(f'  {host}: {values["requests"]} requests, {values["throttled"]} throttled (429),'
+              f' {values["wait_seconds"]:.2f} s waited for the rate limit, budget used: {values["budget_used"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load test against the local mock server")
+    parser.add_argument("--sections", type=int, default=200, help="number of config sections")
+    parser.add_argument("--users", type=int, default=20, help="number of different logins")
+    parser.add_argument("--mode", choices=("timetable", "messages", "both"), default="both")
+    parser.add_argument("--workers", type=int, default=4, help="value of workers in [OUTPUT]")
+    parser.add_argument("--weeks-ahead", type=int, default=0, help="value of weeks_ahead in [OUTPUT]")
+    parser.add_argument("--requests-per-minute", type=float, default=0,
+                        help="value of requests_per_minute in [OUTPUT], 0 means unlimited")
+    parser.add_argument("--concurrent-requests", type=int, default=16, help="value of concurrent_requests in [OUTPUT]")
+    parser.add_argument("--statistics", choices=("xlsx", "db"), help="also write statistics in this format")
+    mock_server.add_settings_arguments(parser)
+    args = parser.parse_args()
+    if args.persons < args.sections:
+        args.persons = args.sections
+
+    server, sink = mock_server.start(settings=mock_server.settings_from(args))
+    with tempfile.TemporaryDirectory() as directory:
+        config = create_config(directory, server.server_port, sink.server_address[1], args)
+        if args.mode in ("timetable", "both"):
+            from webuntis_fetcher import timetable
+            result = run_mode("timetable", timetable.run, config)
+            print_result("timetable", result, args.sections, sum(server.counts.values()))
+        if args.mode in ("messages", "both"):
+            from webuntis_fetcher import messages
+            server.counts.clear()
+            result = run_mode("messages", messages.run, config)
+            mail.close_all()
+            print_result("messages", result, args.sections, sum(server.counts.values()),
+                         f", {sink.emails} emails over {sink.connections} SMTP connection(s)")
+    server.shutdown()
+    sink.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# local stand-in for WebUntis (all endpoints used by this project) and an SMTP sink which only counts emails
+# usage: python3 util/mock_server.py [--port 8080] [--smtp-port 8025] [--latency MS] [--error-rate FRACTION] ...
+# sections have to use "server = http://127.0.0.1:<port>", "firstname = Child<n>" and "lastname = Test"
+
+import argparse
+import datetime
+import json
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import synthetic
+
+# persons in the pageconfig are named Child<n> Test and have the id PERSON_OFFSET + n
+PERSON_OFFSET = 1000
+
+
+class Settings:
+    """
+    Behaviour of the mock server: latency (milliseconds, the actual value varies between half and one
+    and a half times of it), the fraction of API requests answered with 500 or 429, the data volume
+    and the number of persons in the pageconfig.
+    """
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, throttle_rate: float = 0,
+                 profile: str = "student-small", persons: int = 500, messages: int = 5, attachments: int = 1,
+                 attachment_kb: int = 100):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.profile = synthetic.PROFILES[profile]
+        self.persons = persons
+        self.messages = messages
+        self.attachments = attachments
+        self.attachment_kb = attachment_kb
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status: int, body, content_type: str = "application/json", headers=()):
+        if not isinstance(body, bytes):
+            body = (json.dumps(body) if content_type == "application/json" else body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        server = self.server
+        settings = server.settings
+        path = urlsplit(self.path).path
+        query = parse_qs(urlsplit(self.path).query)
+        if self.headers.get("Content-Length"):
+            self.rfile.read(int(self.headers["Content-Length"]))
+        server.count(path)
+        if settings.latency:
+            time.sleep(settings.latency * random.uniform(0.5, 1.5) / 1000)
+
+        if path == "/WebUntis/":
+            return self.send(200, "<html></html>", "text/html",
+                             [("Set-Cookie", f"JSESSIONID={random.getrandbits(64):x}; Path=/WebUntis")])
+        if path == "/WebUntis/j_spring_security_check":
+            server.tokens[self.headers.get("Cookie", "")] = query["j_username"][0]
+            return self.send(200, "{}", "application/json")
+        if path == "/WebUntis/api/token/new":
+            username = server.tokens.get(self.headers.get("Cookie", ""))
+            if username is None:
+                return self.send(401, {"error": "not logged in"})
+            return self.send(200, f"token-{username}", "text/plain")
+        if path.startswith("/download/"):
+            return self.send(200, b"%PDF" + b"x" * (settings.attachment_kb * 1024), "application/pdf")
+
+        authorization = self.headers.get("Authorization", "")
+        if not authorization.startswith("Bearer token-"):
+            return self.send(401, {"error": "invalid token"})
+        username = authorization[len("Bearer token-"):]
+        if random.random() < settings.throttle_rate:
+            return self.send(429, {"error": "too many requests"}, headers=[("Retry-After", "1")])
+        if random.random() < settings.error_rate:
+            return self.send(500, {"error": "random failure"})
+
+        if path == "/WebUntis/api/public/timetable/weekly/pageconfig":
+            elements = [{"id": PERSON_OFFSET + number, "forename": f"Child{number}", "longName": "Test"}
+                        for number in range(1, settings.persons + 1)]
+            return self.send(200, {"data": {"elements": elements}})
+        if path == "/WebUntis/api/public/timetable/weekly/data":
+            week_start_date = datetime.date.fromisoformat(query["date"][0])
+            person_id = int(query["elementId"][0]) if query["elementId"][0] != "None" else 0
+            return self.send(200, synthetic.week_data(settings.profile, week_start_date, seed=person_id,
+                                                      person_id=person_id))
+        if path == "/WebUntis/api/public/timegrid":
+            return self.send(200, synthetic.timegrid(settings.profile.slots))
+        if path == "/WebUntis/api/rest/view/v1/messages":
+            ids = message_ids(username, settings)
+            return self.send(200, {"incomingMessages": [message(message_id) for message_id in ids[1:]],
+                                   "readConfirmationMessages": [message(message_id) for message_id in ids[:1]]})
+        if path.startswith("/WebUntis/api/rest/view/v1/messages/"):
+            parts = path.split("/")
+            if parts[-1] == "attachmentstorageurl":
+                return self.send(200, {"downloadUrl": f"http://{self.headers['Host']}/download/{parts[-2]}",
+                                       "additionalHeaders": [{"key": "x-amz-date", "value": "20250101T000000Z"}]})
+            if parts[-1] == "read-confirmation":
+                return self.send(200, {"confirmationDate": datetime.datetime.now().isoformat(timespec="seconds")})
+            message_id = int(parts[-1])
+            return self.send(200, {"content": f"Content of message {message_id}\n" * 20,
+                                   "storageAttachments": [{"id": f"{message_id}-{number}",
+                                                           "name": f"attachment-{number}.pdf"}
+                                                          for number in range(settings.attachments)]})
+        self.send(404, {"error": f"unknown path {path}"})
+
+
+def message_ids(username: str, settings: Settings) -> list:
+    base = sum(username.encode()) * 10000 + len(username) * 1000
+    return [base + number for number in range(settings.messages)]
+
+
+def message(message_id: int) -> dict:
+    return {"id": message_id, "subject": f"Message {message_id}", "sender": {"displayName": "Mock School"}}
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, settings: Settings):
+        super().__init__(("127.0.0.1", port), MockHandler)
+        self.settings = settings
+        self.tokens = dict()
+        self.counts = dict()
+        self.lock = threading.Lock()
+
+    def count(self, path: str):
+        if path.startswith("/WebUntis/api/rest/view/v1/messages/"):
+            path = "/WebUntis/api/rest/view/v1/messages/..."
+        elif path.startswith("/download/"):
+            path = "/download/..."
+        with self.lock:
+            self.counts[path] = self.counts.get(path, 0) + 1
+
+
+class SmtpHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(b"220 mock SMTP sink\r\n")
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if in_data:
+                if line == b".\r\n":
+                    in_data = False
+                    self.server.received()
+                    self.wfile.write(b"250 OK\r\n")
+                continue
+            command = line[:4].upper()
+            if command in (b"EHLO", b"HELO"):
+                self.wfile.write(b"250 mock\r\n")
+            elif command == b"DATA":
+                in_data = True
+                self.wfile.write(b"354 go ahead\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """
+    Accepts all emails and only counts them.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int):
+        super().__init__(("127.0.0.1", port), SmtpHandler)
+        self.emails = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def received(self):
+        with self.lock:
+            self.emails += 1
+
+    def get_request(self):
+        with self.lock:
+            self.connections += 1
+        return super().get_request()
+
+
+def start(port: int = 0, smtp_port: int = 0, settings: Settings = None):
+    """
+    Starts the mock server and the SMTP sink in background threads (port 0 means any free port).
+    """
+    server = MockServer(port, settings or Settings())
+    sink = SmtpSink(smtp_port)
+    for instance in (server, sink):
+        threading.Thread(target=instance.serve_forever, daemon=True).start()
+    return server, sink
+
+
+def add_settings_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0, help="average latency in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of API requests failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="fraction of API requests answered with 429")
+    parser.add_argument("--profile", default="student-small", choices=sorted(synthetic.PROFILES),
+                        help="size of the weekly data")
+    parser.add_argument("--persons", type=int, default=500, help="number of persons in the pageconfig")
+    parser.add_argument("--messages", type=int, default=5, help="number of messages per user")
+    parser.add_argument("--attachments", type=int, default=1, help="number of attachments per message")
+    parser.add_argument("--attachment-kb", type=int, default=100, help="size of each attachment")
+
+
+def settings_from(args) -> Settings:
+    return Settings(latency=args.latency, error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                    profile=args.profile, persons=args.persons, messages=args.messages,
+                    attachments=args.attachments, attachment_kb=args.attachment_kb)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="local stand-in for WebUntis and an SMTP sink")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--smtp-port", type=int, default=8025)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    server, sink = start(args.port, args.smtp_port, settings_from(args))
+    print(f"WebUntis mock on http://127.0.0.1:{server.server_port}, SMTP sink on 127.0.0.1:{sink.server_address[1]}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"requests: {sum(server.counts.values())}, emails: {sink.emails}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
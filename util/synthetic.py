@@ -0,0 +1,127 @@
+# synthetic WebUntis responses for the benchmarks and the mock server - no real data involved
+
+import datetime
+import random
+
+# element types in the weekly data of WebUntis
+GROUP = 1
+TEACHER = 2
+SUBJECT = 3
+ROOM = 4
+STUDENT = 5
+
+CELL_STATES = ["STANDARD"] * 12 + ["CANCEL", "SUBSTITUTION", "EXAM", "ROOMSUBSTITUTION", "FREE", "ADDITIONAL", "SHIFT"]
+TEXTS = ["Klassenarbeit", "bitte Buch mitbringen", "Raumänderung", "Vertretung", "Exkursion zum Museum"]
+
+
+class Profile:
+    """
+    Describes the size of the generated data: number of elements of each type, time slots per day,
+    parallel periods per slot and the maximum number of groups of a period.
+    """
+
+    def __init__(self, name: str, student: bool, groups: int, teachers: int, subjects: int, rooms: int,
+                 slots: int, parallel: int, groups_per_period: int = 1):
+        self.name = name
+        self.student = student
+        self.groups = groups
+        self.teachers = teachers
+        self.subjects = subjects
+        self.rooms = rooms
+        self.slots = slots
+        self.parallel = parallel
+        self.groups_per_period = groups_per_period
+
+
+PROFILES = {profile.name: profile for profile in (
+    Profile("student-small", True, groups=3, teachers=15, subjects=12, rooms=10, slots=8, parallel=1),
+    Profile("student-large", True, groups=30, teachers=80, subjects=30, rooms=60, slots=10, parallel=3,
+            groups_per_period=2),
+    Profile("teacher-medium", False, groups=40, teachers=100, subjects=40, rooms=60, slots=10, parallel=2,
+            groups_per_period=3),
+    Profile("teacher-large", False, groups=200, teachers=300, subjects=80, rooms=150, slots=12, parallel=8,
+            groups_per_period=6),
+)}
+
+PERSON_ID = 4711
+
+
+def slot_times(slots: int) -> list:
+    """
+    Returns (start, end) in WebUntis notation (e.g. 745 for 07:45) of 45 minute slots with 5 minute breaks.
+    """
+    times = list()
+    minutes = 7 * 60 + 45
+    for _ in range(slots):
+        times.append((minutes // 60 * 100 + minutes % 60, (minutes + 45) // 60 * 100 + (minutes + 45) % 60))
+        minutes += 50
+    return times
+
+
+def elements(profile: Profile) -> list:
+    result = list()
+    for element_type, count, prefix in ((GROUP, profile.groups, "G"), (TEACHER, profile.teachers, "T"),
+                                        (SUBJECT, profile.subjects, "S"), (ROOM, profile.rooms, "R")):
+        for element_id in range(1, count + 1):
+            result.append({"type": element_type, "id": element_id, "name": f"{prefix}{element_id}",
+                           "longName": f"{prefix}-long-{element_id}", "displayname": f"{prefix}{element_id}"})
+    return result
+
+
+def week_data(profile: Profile, week_start_date: datetime.date, seed: int = 1, person_id: int = PERSON_ID) -> dict:
+    """
+    Returns a weekly/data response for the week starting at the given Monday.
+    """
+    rnd = random.Random(f"{profile.name}-{week_start_date}-{seed}")
+    periods = list()
+    for day in range(5):
+        date = int((week_start_date + datetime.timedelta(days=day)).strftime("%Y%m%d"))
+        for start_time, end_time in slot_times(profile.slots):
+            if rnd.random() < 0.1:
+                continue
+            for _ in range(rnd.randint(1, profile.parallel)):
+                if (periods and periods[-1]["date"] == date and rnd.random() < 0.3
+                        and periods[-1]["endTime"] != end_time):
+                    # double lessons: same content as the period before
+                    period = dict(periods[-1])
+                    period["startTime"] = start_time
+                    period["endTime"] = end_time
+                    periods.append(period)
+                    continue
+                state = rnd.choice(CELL_STATES)
+                period_elements = [{"type": GROUP, "id": rnd.randint(1, profile.groups), "orgId": 0}
+                                   for _ in range(rnd.randint(1, profile.groups_per_period))]
+                period_elements.append({"type": TEACHER,
+                                        "id": rnd.randint(1, profile.teachers) if profile.student else person_id,
+                                        "orgId": rnd.randint(1, profile.teachers) if state == "SUBSTITUTION" else 0})
+                period_elements.append({"type": SUBJECT, "id": rnd.randint(1, profile.subjects),
+                                        "orgId": rnd.randint(1, profile.subjects) if state == "SHIFT" else 0})
+                period_elements.append({"type": ROOM, "id": rnd.randint(1, profile.rooms),
+                                        "orgId": rnd.randint(1, profile.rooms) if state == "ROOMSUBSTITUTION" else 0})
+                period = {"date": date, "startTime": start_time, "endTime": end_time, "cellState": state,
+                          "elements": period_elements}
+                if rnd.random() < 0.15:
+                    period["lessonText"] = rnd.choice(TEXTS)
+                if rnd.random() < 0.1:
+                    period["substText"] = rnd.choice(TEXTS)
+                periods.append(period)
+    week_elements = elements(profile)
+    if not profile.student:
+        week_elements.append({"type": TEACHER, "id": person_id, "name": "ME", "displayname": "ME"})
+    return {"data": {"result": {"data": {"elementPeriods": {str(person_id): periods},
+                                         "elements": week_elements}}}}
+
+
+def pageconfig(firstname: str, lastname: str, persons: int = 30, person_id: int = PERSON_ID) -> dict:
+    """
+    Returns a pageconfig response which contains the given person among others.
+    """
+    result = [{"id": element_id, "forename": f"First{element_id}", "longName": f"Last{element_id}"}
+              for element_id in range(1, persons + 1)]
+    result.insert(persons // 2, {"id": person_id, "forename": firstname, "longName": lastname})
+    return {"data": {"elements": result}}
+
+
+def timegrid(slots: int = 10) -> dict:
+    return {"data": {"rows": [{"startTime": start_time, "endTime": end_time}
+                              for start_time, end_time in slot_times(slots)]}}